@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+# compare old is_valid_tree (newick then nexus) with sniff_tree + one parse
+# usage: python bench_is_valid_tree.py folder_or_zip [folder_or_zip ...]
+# input could be extracted Dryad datasets or Dryad zip files
+import sys
+from pathlib import Path
+from time import perf_counter
+from zipfile import ZipFile
+
+import dendropy
+
+from utils import is_valid_tree_content, sniff_tree, TARGET_SUFFIX
+from utils import ZIP_SUFFIX
+
+
+def old_is_valid_tree(content: str) -> bool:
+    try:
+        _ = dendropy.Tree.get(data=content, schema='newick')
+        return True
+    except Exception:
+        pass
+    try:
+        _ = dendropy.Tree.get(data=content, schema='nexus')
+        return True
+    except Exception:
+        pass
+    return False
+
+
+def load_corpus(paths: list[Path]) -> list[tuple[str, str]]:
+    # (name, content) of all tree candidates
+    corpus = list()
+    member_suffix = TARGET_SUFFIX - ZIP_SUFFIX
+    for path in paths:
+        if path.is_dir():
+            files = [i for i in path.rglob('*') if i.is_file()]
+        else:
+            files = [path]
+        for file in files:
+            suffix = file.suffix.lower()
+            if suffix in ZIP_SUFFIX:
+                with ZipFile(file, 'r') as z:
+                    for name in z.namelist():
+                        if Path(name).suffix.lower() in member_suffix:
+                            content = z.read(name).decode('utf-8', 'ignore')
+                            corpus.append((f'{file.name}/{name}', content))
+            elif suffix in TARGET_SUFFIX:
+                corpus.append((str(file), file.read_text(errors='ignore')))
+    return corpus
+
+
+def run(func, corpus: list) -> (float, list):
+    start = perf_counter()
+    result = [func(content) for _, content in corpus]
+    return perf_counter() - start, result
+
+
+def main():
+    paths = [Path(i) for i in sys.argv[1:]]
+    if not paths:
+        print('usage: python bench_is_valid_tree.py folder_or_zip ...')
+        return
+    corpus = load_corpus(paths)
+    size = sum(len(i[1]) for i in corpus)
+    print(f'{len(corpus)} files, {size} characters')
+    old_time, old_result = run(old_is_valid_tree, corpus)
+    new_time, new_result = run(is_valid_tree_content, corpus)
+    sniffed = sum(1 for _, content in corpus if sniff_tree(content))
+    print(f'old\t{old_time:.3f}s\t{sum(old_result)} trees')
+    print(f'new\t{new_time:.3f}s\t{sum(new_result)} trees\t'
+          f'{sniffed} passed sniff')
+    if new_time > 0:
+        print(f'speedup\t{old_time/new_time:.1f}x')
+    for (name, _), old, new in zip(corpus, old_result, new_result):
+        if old != new:
+            print('different', name, old, new)
+
+
+if __name__ == '__main__':
+    main()
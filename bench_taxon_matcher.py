@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+# compare old set based assign_taxon_by_text with TaxonMatcher
+# usage: python bench_taxon_matcher.py [result.json.new ...]
+# default input is *.result.json.new in current folder
+import dataclasses
+import json
+import re
+import sys
+from pathlib import Path
+from time import perf_counter
+
+from utils import Result
+from output_tree_info_2 import assign_taxon_by_text_batch
+from taxonomy import get_vocabulary
+
+pattern = re.compile(r'\W')
+vocabulary = get_vocabulary()
+english_set = set(vocabulary.get_words('english'))
+genus_set = set(vocabulary.get_words('genus'))
+family_set = set(vocabulary.get_words('family'))
+order_set = set(vocabulary.get_words('order'))
+
+
+def get_words(record: Result) -> set:
+    word_set = set()
+    for content in (record.title, record.abstract):
+        if content is None:
+            content = ''
+        for word in re.split(pattern, content):
+            if word and len(word) > 1 and word[0].isupper():
+                word_set.add(word)
+    word_set.difference_update(english_set)
+    return word_set
+
+
+def old_assign_taxon_by_text(record: Result) -> str:
+    word_set = get_words(record)
+    order_name = word_set & order_set
+    if order_name:
+        return order_name.pop()
+    family_name = word_set & family_set
+    if family_name:
+        return family_name.pop()
+    genus_name = word_set & genus_set
+    if genus_name:
+        return genus_name.pop()
+    return ''
+
+
+def rank_of(name: str) -> str:
+    if name in order_set:
+        return 'order'
+    elif name in family_set:
+        return 'family'
+    elif name in genus_set:
+        return 'genus'
+    return ''
+
+
+def load_records(files: list[Path]) -> list[Result]:
+    fields = {i.name for i in dataclasses.fields(Result)}
+    records = list()
+    for file in files:
+        for raw in json.load(open(file, 'r')):
+            records.append(Result(**{k: v for k, v in raw.items()
+                                     if k in fields}))
+    return records
+
+
+def main():
+    files = [Path(i) for i in sys.argv[1:]]
+    if not files:
+        files = list(Path('.').glob('*.result.json.new'))
+    records = load_records(files)
+    print(f'{len(files)} files, {len(records)} records')
+    start = perf_counter()
+    old = [old_assign_taxon_by_text(i) for i in records]
+    old_time = perf_counter() - start
+    start = perf_counter()
+    new = assign_taxon_by_text_batch(records)
+    new_time = perf_counter() - start
+    print(f'old\t{old_time:.3f}s\t{sum(1 for i in old if i)} assigned')
+    print(f'new\t{new_time:.3f}s\t{sum(1 for i in new if i)} assigned')
+    if new_time > 0:
+        print(f'speedup\t{old_time/new_time:.1f}x')
+    # old result is random if many names of same rank
+    same = sum(1 for a, b in zip(old, new) if a == b)
+    same_rank = sum(1 for a, b in zip(old, new) if rank_of(a) == rank_of(b))
+    print(f'same name\t{same}\nsame rank\t{same_rank}')
+
+
+if __name__ == '__main__':
+    main()
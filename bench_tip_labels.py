@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+# compare dendropy taxon_namespace with get_tip_labels
+# usage: python bench_tip_labels.py folder [folder ...]
+# input could be tree files in OUT_FOLDER
+import sys
+from pathlib import Path
+from time import perf_counter
+
+import dendropy
+
+from utils import get_tip_labels, TREE_SUFFIX, TXT_SUFFIX
+
+
+def old_get_tip_labels(tree_file: Path) -> list[str] | None:
+    with open(tree_file, 'r', encoding='utf-8', errors='ignore') as _:
+        line = _.readline()
+        if line.startswith('#NEXUS'):
+            schema = 'nexus'
+        else:
+            schema = 'newick'
+    try:
+        tree = dendropy.Tree.get(path=tree_file, schema=schema)
+    except Exception:
+        return None
+    return [name.label for name in tree.taxon_namespace]
+
+
+def run(func, files: list[Path]) -> (float, list):
+    start = perf_counter()
+    result = [func(file) for file in files]
+    return perf_counter() - start, result
+
+
+def main():
+    paths = [Path(i) for i in sys.argv[1:]]
+    if not paths:
+        print('usage: python bench_tip_labels.py folder ...')
+        return
+    suffix = TREE_SUFFIX | TXT_SUFFIX
+    files = list()
+    for path in paths:
+        files.extend(i for i in path.rglob('*')
+                     if i.is_file() and i.suffix.lower() in suffix)
+    size = sum(i.stat().st_size for i in files)
+    print(f'{len(files)} files, {size} bytes')
+    old_time, old_result = run(old_get_tip_labels, files)
+    new_time, new_result = run(get_tip_labels, files)
+    print(f'old\t{old_time:.3f}s\t'
+          f'{sum(1 for i in old_result if i is not None)} parsed')
+    print(f'new\t{new_time:.3f}s\t'
+          f'{sum(1 for i in new_result if i is not None)} parsed')
+    if new_time > 0:
+        print(f'speedup\t{old_time/new_time:.1f}x')
+    for file, old, new in zip(files, old_result, new_result):
+        # new is None means fallback to dendropy
+        if new is not None and old is not None and set(new) != set(old):
+            print('different', file)
+
+
+if __name__ == '__main__':
+    main()
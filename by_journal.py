@@ -16,15 +16,24 @@ file_handler.setFormatter(fmt)
 log.addHandler(file_handler)
 coloredlogs.install(level=logging.INFO, fmt=FMT, datefmt=DATEFMT)
 
+# journals searched at the same time
+JOURNAL_WORKERS = 2
+
 
 async def main():
     with open('journal_list_dryad.txt', 'r') as _:
         journal_list = tuple([i.strip() for i in _.readlines()])
-    headers = await get_api_token()
     async with aiohttp.ClientSession() as session:
-        for journal in reversed(journal_list):
-            log.info(f'Start searching {journal}')
-            await search_journal_in_dryad(session, headers, journal)
+        headers = await get_api_token(session)
+        semaphore = asyncio.Semaphore(JOURNAL_WORKERS)
+
+        async def search_journal(journal: str):
+            async with semaphore:
+                log.info(f'Start searching {journal}')
+                await search_journal_in_dryad(session, headers, journal)
+
+        await asyncio.gather(*[search_journal(journal)
+                               for journal in reversed(journal_list)])
 
 
 if __name__ == '__main__':
@@ -1,15 +1,28 @@
 import asyncio
 import logging
 import json
+import time
 from pathlib import Path
+from typing import BinaryIO
 
 import aiohttp
 
-from utils import get_doi, Result, download
-from utils import filter_tree_from_zip
-from utils import OUT_FOLDER
+from utils import get_doi, Result, TreeInfo, download
+from utils import filter_tree_from_zip, run_in_pool, to_pool_arg
+from utils import store_trees, write_tree_file, get_member_path
+from utils import OUT_FOLDER, MAX_SIZE, TARGET_SUFFIX, limiter, cached_request
+from utils import CachedResponse, PermanentError, RetryableError
+from utils import check_status, retry_call
 
-DRYAD_SERVER = 'https://datadryad.org/api/v2'
+DRYAD_ROOT = 'https://datadryad.org'
+DRYAD_SERVER = f'{DRYAD_ROOT}/api/v2'
+# list files of dataset and only download tree candidates instead of whole
+# dataset zip, fallback to zip if listing fail
+SELECTIVE_DOWNLOAD = True
+# concurrent dataset downloads
+DOWNLOAD_WORKERS = 4
+# concurrent file downloads in one dataset, each keeps a temp file open
+FILE_WORKERS = 2
 NEXUS_SUFFIX = '.nex,.nexus'.split(',')
 log = logging.getLogger('fetch_tree')
 
@@ -24,47 +37,222 @@ test_doi = ['10.1101/2020.10.08.331355',
             '10.1111/evo.12614']
 
 
-async def get_api_token() -> dict:
-    with open('key.txt', 'r') as f:
-        client_id = f.readline().strip()
-        client_secret = f.readline().strip()
-    url = 'https://datadryad.org/oauth/token'
-    headers = {'Content-Type': 'application/x-www-form-urlencoded',
-               'charset': 'UTF-8'}
+class DryadToken:
+    # oauth token of dryad, cached in memory and on disk with expire time
+    # headers dict is shared by all callers and updated in place when refresh,
+    # so old references always hold current token
+    token_url = 'https://datadryad.org/oauth/token'
+    # refresh before expire
+    margin = 300
+    # wait before next refresh if fail
+    retry_wait = 60
+
+    def __init__(self, key_file=Path('key.txt'),
+                 cache_file=Path('dryad_token.json')):
+        self.key_file = key_file
+        self.cache_file = cache_file
+        self.headers = dict()
+        self.expires_at = 0.0
+        # no refresh before this time after a failed one, even without token
+        self.next_attempt = 0.0
+        self._lock = None
+        self._loop = None
+        self.load()
+
+    def _get_lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def load(self) -> None:
+        if not self.cache_file.exists():
+            return
+        try:
+            cached = json.loads(self.cache_file.read_text())
+            access_token = cached['access_token']
+            expires_at = float(cached['expires_at'])
+        except (ValueError, KeyError):
+            return
+        self.headers['Authorization'] = f'Bearer {access_token}'
+        self.expires_at = expires_at
+
+    def valid(self) -> bool:
+        return (bool(self.headers) and
+                time.time() < self.expires_at - self.margin)
+
+    def invalidate(self, authorization: str | None = None) -> None:
+        # authorization: the failed one, skip if already refreshed by others
+        if (authorization is not None and
+                self.headers.get('Authorization', None) != authorization):
+            return
+        self.expires_at = 0.0
+
+    def waiting(self) -> bool:
+        return time.time() < self.next_attempt
+
+    async def refresh(self, session: aiohttp.ClientSession) -> dict:
+        with open(self.key_file, 'r') as f:
+            client_id = f.readline().strip()
+            client_secret = f.readline().strip()
+        headers = {'Content-Type': 'application/x-www-form-urlencoded',
+                   'charset': 'UTF-8'}
+
+        async def post() -> dict:
+            await limiter.wait(self.token_url)
+            async with session.post(self.token_url, headers=headers, params={
+                'client_id': client_id,
+                'client_secret': client_secret,
+                'grant_type': 'client_credentials'
+            }) as resp:
+                check_status(resp.status, resp.headers, self.token_url)
+                return await resp.json()
+
+        try:
+            token = await retry_call(post)
+        except (PermanentError, RetryableError, aiohttp.ClientError,
+                asyncio.TimeoutError, ConnectionError) as e:
+            # old token may still work, keep it and try again later
+            log.warning(f'Get token fail {e!r}')
+            self.next_attempt = time.time() + self.retry_wait
+            return self.headers
+        self.headers['Authorization'] = f'Bearer {token["access_token"]}'
+        self.expires_at = time.time() + float(token.get('expires_in', 3600))
+        self.cache_file.write_text(json.dumps(
+            {'access_token': token['access_token'],
+             'expires_at': self.expires_at}))
+        log.info('Token ok')
+        return self.headers
+
+    async def get(self, session: aiohttp.ClientSession) -> dict:
+        # return cached headers, refresh if expired or about to expire
+        if self.valid() or self.waiting():
+            return self.headers
+        async with self._get_lock():
+            # other coroutine may have refreshed it or failed
+            if not (self.valid() or self.waiting()):
+                await self.refresh(session)
+        return self.headers
+
+
+token_manager = DryadToken()
+
+
+async def get_api_token(session: aiohttp.ClientSession = None) -> dict:
+    if session is not None:
+        return await token_manager.get(session)
     async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, params={
-            'client_id': client_id,
-            'client_secret': client_secret,
-            'grant_type': 'client_credentials'
-        }) as resp:
-            if not resp.ok:
-                log.warning(f'Get token fail {resp.status}')
-                return {}
-            else:
-                print(await resp.json())
-            access_token = (await resp.json())['access_token']
-        headers = {'Authorization': f'Bearer {access_token}'}
-        async with session.get('https://datadryad.org/api/v2/search',
-                               params={'q': '10.1111/jbi.13789'},
-                               headers=headers) as resp:
-            if not resp.ok:
-                log.error('Bad token')
-                print(resp.status, resp.text)
-                return {}
-            else:
-                result = await resp.json()
-                print(result)
-                log.info('Token ok')
-    return headers
-
-
-def get_dryad_url(identifier: str) -> str:
+        return await token_manager.get(session)
+
+
+async def refresh_token(session: aiohttp.ClientSession,
+                        authorization: str | None) -> None:
+    # token expired before expected time
+    log.warning('Token expired, refresh')
+    token_manager.invalidate(authorization)
+    await token_manager.get(session)
+
+
+async def request_dryad(session: aiohttp.ClientSession, url: str,
+                        headers: dict, params=None) -> CachedResponse:
+    # GET with token, refresh and try again once if got 401
+    await token_manager.get(session)
+    authorization = headers.get('Authorization', None)
+    resp = await cached_request(session, 'GET', url, params=params,
+                                headers=headers)
+    if resp.status == 401:
+        await refresh_token(session, authorization)
+        resp = await cached_request(session, 'GET', url, params=params,
+                                    headers=headers)
+    return resp
+
+
+async def download_dryad(session: aiohttp.ClientSession, headers: dict,
+                         download_url: str, size: int
+                         ) -> (bool, bytes | BinaryIO):
+    await token_manager.get(session)
+    authorization = headers.get('Authorization', None)
+    return await download(session, download_url, size, headers=headers,
+                          stream=True, refresh=lambda: refresh_token(
+                              session, authorization))
+
+
+def get_dryad_url(identifier: str, download=True) -> str:
     # dryad doi looks lie 'doi:10.5061/dryad.1g1jwstss'
-    # convert dryad doi to dryad download url
+    # convert dryad doi to dryad download url, or dataset url if not download
     # dryad requires escaped url
     dryad_doi = identifier.replace(':', '%3A').replace('/', '%2F')
-    download_url = f'{DRYAD_SERVER}/datasets/{dryad_doi}/download'
-    return download_url
+    dataset_url = f'{DRYAD_SERVER}/datasets/{dryad_doi}'
+    if not download:
+        return dataset_url
+    return f'{dataset_url}/download'
+
+
+async def list_dryad_files(session: aiohttp.ClientSession, headers: dict,
+                           identifier: str) -> list[tuple[str, str, int]]:
+    # (download_url, filename, size) of files in latest version of dataset
+    resp = await request_dryad(session,
+                               get_dryad_url(identifier, download=False),
+                               headers)
+    if not resp.ok:
+        raise ConnectionError(resp.status)
+    version_href = resp.json()['_links']['stash:version']['href']
+    files_url = f'{DRYAD_ROOT}{version_href}/files'
+    files = list()
+    while files_url:
+        resp = await request_dryad(session, files_url, headers)
+        if not resp.ok:
+            raise ConnectionError(resp.status)
+        page = resp.json()
+        for i in page.get('_embedded', {}).get('stash:files', []):
+            download_href = i['_links']['stash:download']['href']
+            files.append((f'{DRYAD_ROOT}{download_href}', i['path'],
+                          i.get('size', 0)))
+        next_page = page.get('_links', {}).get('next', None)
+        if next_page is None:
+            files_url = ''
+        else:
+            files_url = f'{DRYAD_ROOT}{next_page["href"]}'
+    return files
+
+
+async def download_files(session: aiohttp.ClientSession, headers: dict,
+                         files: list, out_folder: Path,
+                         file_workers=FILE_WORKERS) -> list[TreeInfo] | None:
+    # download tree candidates only, None if all downloads fail
+    to_download = list()
+    for download_url, filename, size in files:
+        if Path(filename).suffix.lower() not in TARGET_SUFFIX:
+            log.info(f'Skip {filename}')
+            continue
+        if size > MAX_SIZE:
+            log.warning(f'Skip {filename}, too big {size} bp')
+            continue
+        to_download.append((download_url, filename, size))
+    if not to_download:
+        return []
+
+    semaphore = asyncio.Semaphore(file_workers)
+
+    async def download_one(download_url: str, filename: str, size: int
+                           ) -> list[TreeInfo] | None:
+        # file is open until written, so keep it in semaphore
+        async with semaphore:
+            ok, bin_data = await download_dryad(session, headers,
+                                                download_url, size)
+            if not ok:
+                return None
+            out_file = get_member_path(filename, out_folder)
+            with bin_data:
+                return await run_in_pool(write_tree_file,
+                                         to_pool_arg(bin_data), out_file)
+
+    downloaded = await asyncio.gather(*[download_one(*i) for i in to_download])
+    if all(i is None for i in downloaded):
+        return None
+    tree_files = [j for i in downloaded if i is not None for j in i]
+    return await store_trees(tree_files)
 
 
 async def search_in_dryad(session: aiohttp.ClientSession, headers: dict,
@@ -72,10 +260,10 @@ async def search_in_dryad(session: aiohttp.ClientSession, headers: dict,
     # search in dryad, return json dict
     search_url = f'{DRYAD_SERVER}/search'
     params = {'q': q, 'page': page, 'per_page': per_page}
-    async with session.get(search_url, params=params, headers=headers) as resp:
-        if not resp.ok:
-            raise ConnectionError(resp.status)
-        return await resp.json()
+    resp = await request_dryad(session, search_url, headers, params=params)
+    if not resp.ok:
+        raise ConnectionError(resp.status)
+    return resp.json()
 
 
 def parse_result(result: dict) -> (str, str, str, str, int, int):
@@ -100,15 +288,45 @@ def parse_result(result: dict) -> (str, str, str, str, int, int):
         yield identifier, title, size, doi_, count, total
 
 
-def write_tree(result, doi, bin_data) -> None:
+async def write_tree(result, doi, bin_data: BinaryIO) -> None:
     out_folder = OUT_FOLDER / get_doi(doi, doi_type='folder')
     try:
         out_folder.mkdir(exist_ok=True)
     except OSError as e:
         log.error(str(e))
         return
-    tree_files = filter_tree_from_zip(bin_data, out_folder)
-    result.add_trees(tree_files)
+    tree_files = await run_in_pool(filter_tree_from_zip,
+                                   to_pool_arg(bin_data), out_folder)
+    result.add_trees(await store_trees(tree_files))
+
+
+async def get_dataset_trees(session: aiohttp.ClientSession, headers: dict,
+                            result: Result, identifier: str, doi: str,
+                            size: int) -> bool:
+    # download trees of dataset into result, return False if download fail
+    if SELECTIVE_DOWNLOAD:
+        try:
+            files = await list_dryad_files(session, headers, identifier)
+        except (ConnectionError, KeyError, ValueError, RetryableError,
+                PermanentError, aiohttp.ClientError,
+                asyncio.TimeoutError) as e:
+            log.warning(f'List files of {identifier} fail {e!r}')
+            files = None
+        if files is not None:
+            out_folder = OUT_FOLDER / get_doi(doi, doi_type='folder')
+            tree_files = await download_files(session, headers, files,
+                                              out_folder)
+            if tree_files is None:
+                return False
+            result.add_trees(tree_files)
+            return True
+    download_url = get_dryad_url(identifier)
+    ok, bin_data = await download_dryad(session, headers, download_url, size)
+    if not ok:
+        return False
+    with bin_data:
+        await write_tree(result, doi, bin_data)
+    return True
 
 
 async def search_doi_in_dryad(session: aiohttp.ClientSession, doi: str,
@@ -119,14 +337,29 @@ async def search_doi_in_dryad(session: aiohttp.ClientSession, doi: str,
     return identifier, title, size
 
 
+async def download_dataset(session: aiohttp.ClientSession, headers: dict,
+                           record: tuple, semaphore: asyncio.Semaphore,
+                           n: int) -> dict | None:
+    identifier, title, size, doi_, count, total = record
+    log.info(f'{n}\t{identifier}/{total}')
+    if identifier == '':
+        return None
+    result = Result(title, identifier, doi_)
+    async with semaphore:
+        ok = await get_dataset_trees(session, headers, result, identifier,
+                                     doi_, size)
+    if not ok:
+        return None
+    return result.to_dict()
+
+
 async def search_journal_in_dryad(session: aiohttp.ClientSession,
-                                  headers: dict, journal: str):
-    results = list()
+                                  headers: dict, journal: str,
+                                  workers=DOWNLOAD_WORKERS):
     output_json = journal.replace(' ', '_') + '.result.json'
     if Path(output_json).exists():
         log.info(f'{journal} already searched.')
         return ''
-    count_have_tree = 0
     max_per_page = 100
     try_search_result = await search_in_dryad(session, headers, journal, page=1,
                                               per_page=1)
@@ -135,26 +368,26 @@ async def search_journal_in_dryad(session: aiohttp.ClientSession,
         log.error(f'0 record found for {journal}')
         return ''
     log.info(f'Got {total} records from journal {journal}')
-    for page in range(1, total//max_per_page + 2):
-        log.info(f'{page}-{page*max_per_page}')
-        search_result = await search_in_dryad(session, headers, journal,
-                                              page=page, per_page=max_per_page)
-        for n, record in enumerate(parse_result(search_result)):
-            identifier, title, size, doi_, count, total = record
-            log.info(f'{n+(page-1)*max_per_page}\t{identifier}/{total}')
-            if identifier == '':
-                continue
-            result = Result(title, identifier, doi_)
-            download_url = get_dryad_url(identifier)
-            ok, bin_data = await download(session, download_url, size,
-                                          headers=headers)
-            if not ok:
-                continue
-            else:
-                write_tree(result, doi_, bin_data)
-                count_have_tree += 1
-                results.append(result.to_dict())
-    log.info(f'{count_have_tree} have trees')
+    # fetch all pages at once, speed is limited by utils.limiter
+    pages = range(1, total//max_per_page + 2)
+    search_results = await asyncio.gather(
+        *[search_in_dryad(session, headers, journal, page=page,
+                          per_page=max_per_page) for page in pages])
+    records = [record for search_result in search_results
+               for record in parse_result(search_result)]
+    semaphore = asyncio.Semaphore(workers)
+    # gather keep the order of records, so output is same as sequential
+    # one failed dataset should not abort the whole journal
+    downloaded = await asyncio.gather(
+        *[download_dataset(session, headers, record, semaphore, n)
+          for n, record in enumerate(records)], return_exceptions=True)
+    results = list()
+    for record, i in zip(records, downloaded):
+        if isinstance(i, BaseException):
+            log.warning(f'Download dataset {record[0]} fail {i!r}')
+        elif i is not None:
+            results.append(i)
+    log.info(f'{len(results)} have trees')
     log.info(f'Writing results {output_json}')
     with open(output_json, 'w') as f:
         json.dump(results, f, indent=True)
@@ -168,19 +401,13 @@ async def get_trees_dryad(session: aiohttp.ClientSession, doi_raw: str,
     result = Result(title, identifier, doi)
     if identifier == '':
         return result
-    download_url = get_dryad_url(identifier)
-    ok, bin_data = await download(session, download_url, size,
-                                  headers=headers)
-    if not ok:
-        return result
-    else:
-        write_tree(result, doi, bin_data)
+    await get_dataset_trees(session, headers, result, identifier, doi, size)
     return result
 
 
 async def dryad_main(doi_list: list) -> tuple:
-    headers = await get_api_token()
     async with aiohttp.ClientSession() as session:
+        headers = await get_api_token(session)
         results = await asyncio.gather(
             *[get_trees_dryad(session, doi, headers) for doi in doi_list])
     for i in results:
@@ -20,12 +20,67 @@ log.addHandler(file_handler)
 coloredlogs.install(level=logging.INFO, fmt=FMT, datefmt=DATEFMT)
 
 CHECK_SIZE = 50
+# concurrent DOI workers, actual speed is limited by utils.limiter
+WORKERS = 8
 
 
-async def main(input_list: list):
+class Progress:
+    # records may finish out of order, only the contiguous finished part
+    # is written to output json and checkpoint, so resume never skip or
+    # duplicate records
+    def __init__(self, start: int, results: list, checkpoint: Path,
+                 output_json: Path):
+        self.next_n = start
+        self.start = start
+        self.pending = dict()
+        self.results = results
+        self.checkpoint = checkpoint
+        self.output_json = output_json
+        self.count_have_tree = 0
+
+    def finish(self, n: int, record: dict | None) -> None:
+        self.pending[n] = record
+        while self.next_n in self.pending:
+            record = self.pending.pop(self.next_n)
+            if record is not None:
+                self.count_have_tree += 1
+                self.results.append(record)
+            self.next_n += 1
+            if (self.next_n - self.start) % CHECK_SIZE == 0:
+                log.warning(f'Processed {self.next_n-self.start} records')
+                self.save()
+
+    def save(self, indent=None) -> None:
+        log.warning(f'Writing results {self.output_json}')
+        with open(self.output_json, 'w') as f:
+            json.dump(self.results, f, indent=indent)
+        self.checkpoint.write_text(str(self.next_n))
+
+
+async def worker(session: aiohttp.ClientSession, headers: dict,
+                 queue: asyncio.Queue, progress: Progress) -> None:
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        n, record = item
+        doi = record['doi']
+        log.info(f'{n+1} {doi}')
+        result = await get_trees_figshare(session, doi)
+        if not result.have_tree():
+            result = await get_trees_dryad(session, doi, headers)
+        if result.have_tree():
+            log.info(f'Found trees in {doi}')
+            record['tree_files'] = tuple(result.tree_files)
+            record['tree_info'] = tuple(result.tree_info)
+            progress.finish(n, record)
+        else:
+            progress.finish(n, None)
+
+
+async def main(input_list: list, workers=WORKERS):
     input_jsons = [i for i in input_list if 'result' not in i.name]
     for input_json in input_jsons:
-        headers = await get_api_token()
         log.info(input_json)
         output_json = input_json.with_suffix('.result.json')
         checkpoint = input_json.with_suffix('.checkpoint')
@@ -38,40 +93,23 @@ async def main(input_list: list):
             checkpoint_n = 0
         data = json.load(input_json.open())
         log.info(f'{len(data)} records')
-        count = 0
-        count_have_tree = 0
-        test = ['10.1002/ajb2.1682', '10.1002/ajb2.1738', '10.1002/ajb2.1797',
-                '10.1002/ajb2.1453']
-        test2 = [{'doi': i} for i in test]
+        progress = Progress(checkpoint_n, results, checkpoint, output_json)
+        queue = asyncio.Queue()
+        for n in range(checkpoint_n, len(data)):
+            queue.put_nowait((n, data[n]))
+        for _ in range(workers):
+            queue.put_nowait(None)
         async with aiohttp.ClientSession() as session:
-            # for record in test2:
-            for record in data[checkpoint_n:]:
-                # API limit
-                # 120/min
-                await asyncio.sleep(1)
-                doi = record['doi']
-                log.info(f'{count+checkpoint_n+1} {doi}')
-                result = await get_trees_figshare(session, doi)
-                if not result.have_tree():
-                    result = await get_trees_dryad(session, doi, headers)
-                count += 1
-                if result.have_tree():
-                    log.info(f'Found trees in {doi}')
-                    count_have_tree += 1
-                    record['tree_files'] = tuple(result.tree_files)
-                    results.append(record)
-                if count % CHECK_SIZE == 0:
-                    log.warning(f'Processed {count} records')
-                    checkpoint.write_text(str(count+checkpoint_n))
-                    log.warning(f'Writing results {output_json}')
-                    with open(output_json, 'w') as f:
-                        json.dump(results, f)
-        log.info(f'{count} records')
-        log.info(f'{count_have_tree} have trees')
-        log.info(f'Writing results {output_json}')
-        with open(output_json, 'w') as f:
-            json.dump(results, f, indent=True)
-        checkpoint.write_text(str(count + checkpoint_n))
+            # token is cached and refreshed by dryad.token_manager
+            headers = await get_api_token(session)
+            # if one worker fails, others are cancelled and checkpoint keeps
+            # the last contiguous position
+            async with asyncio.TaskGroup() as tg:
+                for _ in range(workers):
+                    tg.create_task(worker(session, headers, queue, progress))
+        log.info(f'{progress.next_n-checkpoint_n} records')
+        log.info(f'{progress.count_have_tree} have trees')
+        progress.save(indent=True)
     return
 
 
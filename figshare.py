@@ -4,13 +4,17 @@ import logging
 
 from aiohttp import ClientSession
 
-from utils import filter_tree_from_zip, is_valid_tree
-from utils import download, Result, get_doi
+from utils import filter_tree_from_zip, check_tree_file, TreeInfo
+from utils import run_in_pool, to_pool_arg, store_trees
+from utils import download, Result, get_doi, write_stream, cached_request
 from utils import TREE_SUFFIX, ZIP_SUFFIX, TXT_SUFFIX, OUT_FOLDER
 
 # figshare item type id
 DATASET = 3
 FIGSHARE_SERVER = 'https://api.figshare.com/v2'
+# concurrent article info requests and file downloads of one doi
+ARTICLE_WORKERS = 4
+DOWNLOAD_WORKERS = 2
 log = logging.getLogger('fetch_tree')
 
 # https://api.figshare.com/v2/file/download/17716346 fail 403
@@ -35,79 +39,118 @@ async def search_doi_in_figshare(session: ClientSession, raw_doi: str) -> list:
     doi = get_doi(raw_doi=raw_doi)
     # search_for = ':title: phylogeny'
     params = {'item_type': DATASET, 'search_for': f':resource_doi: {doi}'}
-    async with session.post(search_url, params=params) as resp:
-        if not resp.ok:
-            log.error(f'Search fail {raw_doi} {resp.ok}')
-            return list()
-        article_list = await resp.json()
-        if len(article_list) == 0:
-            return list()
+    resp = await cached_request(session, 'POST', search_url, params=params)
+    if not resp.ok:
+        log.error(f'Search fail {raw_doi} {resp.status}')
+        return list()
+    article_list = resp.json()
+    if len(article_list) == 0:
+        return list()
     article_urls = [article['url'] for article in article_list]
     return article_urls
 
 
-async def get_trees_figshare(session: ClientSession, doi: str) -> Result:
+def write_figshare_file(bin_data: bytes | Path, download_url: str,
+                        filename: Path) -> list[TreeInfo]:
+    # run in process pool, so bin_data is bytes or path of downloaded file
+    file_id = download_url.split('/')[-1]
+    out_folder = OUT_FOLDER / file_id
+    out_folder.mkdir(exist_ok=True)
+    out_file = out_folder / filename
+    tree_files = list()
+    suffix = filename.suffix.lower()
+    if suffix in ZIP_SUFFIX:
+        tree_files = filter_tree_from_zip(bin_data, out_folder)
+    elif suffix in TREE_SUFFIX or suffix in TXT_SUFFIX:
+        # todo: assume filenames are all unique!
+        # tree suffix is checked too, tree count and kind come from check
+        write_stream(bin_data, out_file)
+        tree_info = check_tree_file(out_file)
+        if tree_info is not None:
+            tree_files.append(tree_info)
+        else:
+            log.info(f'{filename} is not valid tree')
+            out_file.unlink()
+            out_folder.rmdir()
+    else:
+        out_folder.rmdir()
+    return tree_files
+
+
+async def get_article_files(session: ClientSession, doi: str,
+                            article_url: str) -> (str, str, list) | None:
+    # return title, identifier and files may contain trees of one article
+    # return None if fail, so that other articles are not affected
+    try:
+        resp = await cached_request(session, 'GET', article_url)
+    except Exception as e:
+        log.error(f'Get {article_url} fail {e!r}')
+        return None
+    if not resp.ok:
+        log.error(f'Get {article_url} fail {resp.status}')
+        return None
+    article_info = resp.json()
+    if 'files' not in article_info:
+        # no files in this article
+        return None
+    title = article_info['resource_title']
+    identifier = article_info['doi']
+    to_download = list()
+    for i in article_info['files']:
+        filename = Path(i['name'])
+        file_id = i['id']
+        download_url = f'{FIGSHARE_SERVER}/file/download/{file_id}'
+        file_suffix = filename.suffix.lower()
+        # figshare have name info before download and extraction
+        if (file_suffix not in TREE_SUFFIX) and (
+                file_suffix not in ('.txt', '.zip')):
+            log.info(f'Skip {filename} in {doi}')
+            continue
+        else:
+            log.info(f'{filename} may be a tree file')
+        to_download.append((download_url, i['size'], filename))
+    return title, identifier, to_download
+
+
+async def get_trees_figshare(session: ClientSession, doi: str,
+                             article_workers=ARTICLE_WORKERS,
+                             download_workers=DOWNLOAD_WORKERS) -> Result:
     emtpy_headers = {}
     article_urls = await search_doi_in_figshare(session, doi)
     if len(article_urls) == 0:
         return Result(doi=doi)
-    to_download = list()
-    for article_url in article_urls:
-        async with session.get(article_url) as resp:
-            if not resp.ok:
-                return Result(doi=doi)
-            article_info = await resp.json()
-            if 'files' not in article_info:
-                # no files in this article
-                return Result(doi=doi)
-            # repeat assignment?
-            title = article_info['resource_title']
-            identifier = article_info['doi']
-            for i in article_info['files']:
-                filename = Path(i['name'])
-                file_id = i['id']
-                download_url = f'{FIGSHARE_SERVER}/file/download/{file_id}'
-                file_suffix = filename.suffix.lower()
-                # figshare have name info before download and extraction
-                if (file_suffix not in TREE_SUFFIX) and (
-                        file_suffix not in ('.txt', '.zip')):
-                    log.info(f'Skip {filename} in {doi}')
-                    continue
-                else:
-                    log.info(f'{filename} may be a tree file')
-                to_download.append((download_url, i['size'], filename))
+    article_semaphore = asyncio.Semaphore(article_workers)
+
+    async def get_article(article_url: str):
+        async with article_semaphore:
+            return await get_article_files(session, doi, article_url)
+
+    articles = await asyncio.gather(*[get_article(i) for i in article_urls])
+    articles = [i for i in articles if i is not None]
+    if not articles:
+        return Result(doi=doi)
+    # repeat assignment?
+    title, identifier, _ = articles[-1]
+    to_download = [j for i in articles for j in i[2]]
     result = Result(title, identifier, doi)
-    downloads = await asyncio.gather(*[download(session, download_url,
-                                                size, emtpy_headers) for
-                                       download_url, size, _ in to_download], )
-    all_tree_files = list()
-    for x, y in zip(downloads, to_download):
-        ok, bin_data = x
-        download_url, filesize, filename = y
-        if not ok:
-            continue
-        file_id = download_url.split('/')[-1]
-        out_folder = OUT_FOLDER / file_id
-        out_folder.mkdir(exist_ok=True)
-        out_file = out_folder / filename
-        if filename in TREE_SUFFIX:
-            # todo: assume filenames are all unique!
-            out_file.write_bytes(bin_data)
-            all_tree_files.append(out_file)
-        elif filename.suffix.lower() in ZIP_SUFFIX:
-            tree_files = filter_tree_from_zip(bin_data, out_folder)
-            all_tree_files.extend(tree_files)
-        elif filename.suffix.lower() in TXT_SUFFIX:
-            out_file.write_bytes(bin_data)
-            if is_valid_tree(out_file):
-                all_tree_files.append(out_file)
-            else:
-                log.info(f'{filename} is not valid tree')
-                out_file.unlink()
-                out_folder.rmdir()
-        else:
-            out_folder.rmdir()
-    result.add_trees(all_tree_files)
+    download_semaphore = asyncio.Semaphore(download_workers)
+
+    async def download_one(download_url: str, size: int, filename: Path
+                           ) -> list[TreeInfo]:
+        # file is open until written, so keep it in semaphore
+        async with download_semaphore:
+            ok, bin_data = await download(session, download_url, size,
+                                          emtpy_headers, stream=True)
+            if not ok:
+                return []
+            with bin_data:
+                return await run_in_pool(write_figshare_file,
+                                         to_pool_arg(bin_data), download_url,
+                                         filename)
+
+    downloads = await asyncio.gather(*[download_one(*i) for i in to_download])
+    all_tree_files = [j for i in downloads for j in i]
+    result.add_trees(await store_trees(all_tree_files))
     return result
 
 
@@ -7,7 +7,7 @@ from pathlib import Path
 from aiohttp import ClientSession
 import coloredlogs
 
-from utils import get_doi, pprint, Result
+from utils import get_doi, pprint, Result, cached_request
 from global_vars import log
 
 QUERY_URL = 'https://api.crossref.org/works/'
@@ -16,30 +16,30 @@ EMAIL = 'wpwupingwp@outlook.com'
 
 async def query_doi(session: ClientSession, doi: str) -> dict:
     """
-    50/s rate limit
+    50/s rate limit, see utils.RATE_LIMITS
     cannot use "select"
     'select': ('DOI,abstract,author,volume,title,issue,'
                'container-title,published')}
     """
     params = {'mailto': EMAIL}
     proxy = 'http://127.0.0.1:7890'
-    await asyncio.sleep(0.03)
-    async with session.get(QUERY_URL + doi, params=params, proxy=proxy) as resp:
-        if resp.status != 200:
-            print((await resp.text()))
-            return {}
-        r = await resp.json()
-        msg = r['message']
-        # pprint(r)
-        if 'DOI' not in msg:
-            print(doi, 'not found')
-            # pprint(msg)
-            return {}
-        if doi != msg['DOI']:
-            log.error('bad record')
-            return {}
-        else:
-            return msg
+    resp = await cached_request(session, 'GET', QUERY_URL + doi,
+                                params=params, proxy=proxy)
+    if resp.status != 200:
+        print(resp.text())
+        return {}
+    r = resp.json()
+    msg = r['message']
+    # pprint(r)
+    if 'DOI' not in msg:
+        print(doi, 'not found')
+        # pprint(msg)
+        return {}
+    if doi != msg['DOI']:
+        log.error('bad record')
+        return {}
+    else:
+        return msg
 
 
 def fill_field(record: Result, msg: dict) -> Result:
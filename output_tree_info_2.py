@@ -1,74 +1,97 @@
 #!/usr/bin/python3
 import dataclasses
 import json
-import re
+import os
+import sys
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from hashlib import sha1
 
 import dendropy
-from utils import Result
+from utils import Result, get_tip_labels
+from taxon_matcher import TaxonMatcher
+from taxonomy import get_vocabulary, PHRASES, DATA_FOLDER, LINEAGE
 from global_vars import log
 
-pattern = re.compile(r'\W')
-
-
-# def get_word_list() -> (set, set, set, set):
-    # from barcodefinder
-    # https://www.ef.edu/english-resources/english-vocabulary/top-1000-words/
-with open('data/1000_frequent_words .txt', 'r') as _:
-    english_set_ = list(_.read().strip().split(','))
-    english_set = {word.capitalize() for word in english_set_}
-with open('data/genus.csv', 'r') as _:
-    genus_set = set(_.read().strip().split(','))
-with open('data/other_families.csv', 'r') as _:
-    family_set = set(_.read().strip().split(','))
-with open('data/plant_families.csv', 'r') as _:
-    family_set.update(_.read().strip().split(','))
-with open('data/animal_orders.csv', 'r') as _:
-    order_set = set(_.read().strip().split(','))
-with open('data/other_orders.csv', 'r') as _:
-    order_set.update(_.read().strip().split(','))
-    # return genus_set, family_set, order_set, english_set
-
-
-def get_words(record: Result) -> set:
-    word_set = set()
-    for content in (record.title, record.abstract):
-        if content is None:
-            content = ''
-        for word in re.split(pattern, content):
-            if word and len(word) > 1 and word[0].isupper():
-                word_set.add(word)
-    word_set.difference_update(english_set)
-    return word_set
+# processes for taxon assignment, 0 to run in main process
+WORKERS = os.cpu_count() or 1
+# records per task, small enough to balance big and small journals
+CHUNK_SIZE = 64
+# log progress every PROGRESS_SIZE records
+PROGRESS_SIZE = 1000
+# results of previous runs, only new or changed records are assigned
+TAXON_CACHE = Path('taxon_cache.jsonl')
+# optional genus,family,order mapping for common ancestor
+LINEAGE_FILE = DATA_FOLDER / LINEAGE
+# change it if assign method changed
+CACHE_VERSION = 1
+
+
+@lru_cache(maxsize=None)
+def get_text_matcher() -> TaxonMatcher:
+    # build on first use, not when imported
+    vocabulary = get_vocabulary()
+    ranks = ('order', 'family', 'genus')
+    return TaxonMatcher(
+        {rank: vocabulary.get_set(rank) for rank in ranks},
+        stop_words=vocabulary.get_set('english'),
+        phrases={rank: vocabulary.get_words(PHRASES[rank]) for rank in ranks})
+
+
+def get_text(record: Result) -> str:
+    return '\n'.join([record.title or '', record.abstract or ''])
 
 
 def assign_taxon_by_text(record: Result) -> str:
-    # todo: test
-    word_set = get_words(record)
-    order_name = word_set & order_set
-    if order_name:
-        return order_name.pop()
-    family_name = word_set & family_set
-    if family_name:
-        return family_name.pop()
-    genus_name = word_set & genus_set
-    if genus_name:
-        return genus_name.pop()
-    return ''
+    # order first, then family and genus, earlier in title and abstract first
+    return get_text_matcher().match(get_text(record))
+
+
+def assign_taxon_by_text_batch(records: list[Result]) -> list[str]:
+    return get_text_matcher().match_batch(get_text(i) for i in records)
+
+
+def check_lineage() -> bool:
+    # without lineage, common ancestor is only found if all genera are the same
+    vocabulary = get_vocabulary()
+    if vocabulary.lineage_count == 0:
+        log.warning(f'No genus->family->order lineage in {LINEAGE_FILE}, '
+                    f'tree taxon falls back to the most frequent genus. '
+                    f'Provide the csv (genus,family,order per row) to '
+                    f'enable common ancestor')
+        return False
+    log.info(f'{vocabulary.lineage_count} lineage links loaded')
+    return True
 
 
 def get_taxon_by_names(names: list[str]) -> str:
+    # lowest common ancestor of all genera, if lineage unknown, use the most
+    # frequent genus
+    vocabulary = get_vocabulary()
+    genus_set = vocabulary.get_set('genus')
     genus_count = dict()
     for name in names:
         if name in genus_set:
             genus_count[name] = genus_count.get(name, 0) + 1
-    if len(genus_count) > 0:
-        top = sorted(genus_count.items(), key=lambda x:x[1], reverse=True)[0]
-        log.debug(f'{top[0]} {top[1]} times, set as tree taxon')
-        return top[0]
-    else:
+    if len(genus_count) == 0:
         return ''
+    common = vocabulary.get_common_ancestor(genus_count)
+    if common:
+        log.debug(f'{common} is common ancestor of {len(genus_count)} genera,'
+                  f' set as tree taxon')
+        return common
+    top = sorted(genus_count.items(), key=lambda x:x[1], reverse=True)[0]
+    log.debug(f'{top[0]} {top[1]} times, set as tree taxon')
+    return top[0]
+
+
+def is_same_lineage(a: str, b: str) -> bool:
+    # same name, or one is parent of another
+    if a == b:
+        return True
+    vocabulary = get_vocabulary()
+    return a in vocabulary.get_lineage(b) or b in vocabulary.get_lineage(a)
 
 
 def fix_path(old: str) -> Path:
@@ -80,40 +103,94 @@ def fix_path(old: str) -> Path:
     return new
 
 
-def assign_taxon_by_tree(record: Result) -> str:
+def get_taxon_by_labels(labels: list[str]) -> str:
+    if not labels:
+        return ''
+    names = list()
+    for label in labels:
+        maybe_taxon_name = label.replace('_', ' ').split(' ')
+        names.extend(maybe_taxon_name)
+    return get_taxon_by_names(names)
+
+
+@lru_cache(maxsize=None)
+def get_tree_taxon(tree_file: Path) -> str | None:
+    # for old records without tree_info, read tip labels from tree file
+    # same tree file may be shared by many records, read once
+    # return None if invalid
+    labels = get_tip_labels(tree_file)
+    if labels is not None:
+        return get_taxon_by_labels(labels)
+    # tokens not recognized, let dendropy decide
+    with open(tree_file, 'r', encoding='utf-8', errors='ignore') as _:
+        # print(tree_file)
+        line = _.readline()
+        if line.startswith('#NEXUS'):
+            schema = 'nexus'
+        else:
+            schema = 'newick'
+    try:
+        tree = dendropy.Tree.get(path=tree_file, schema=schema)
+    except Exception:
+        log.warning(f'Invalid tree format {tree_file}')
+        return None
+    labels = [name.label for name in tree.taxon_namespace]
+    return get_taxon_by_labels(labels)
+
+
+def get_tree_key(tree_file: str, info: dict | None) -> str:
+    # same labels give same taxon, old records use file size and mtime
+    # return '' if not found
+    if info is not None:
+        return f'labels:{info["label_digest"]}'
+    path = fix_path(tree_file)
+    try:
+        stat = path.stat()
+    except OSError:
+        return ''
+    return f'file:{path}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def get_text_key(record: Result) -> str:
+    return 'text:' + sha1(get_text(record).encode('utf-8')).hexdigest()
+
+
+def assign_taxon_by_tree(record: Result, tree_taxa: dict | None = None,
+                         compute=True) -> str | None:
     # todo: test
     # assume one paper for one taxon
+    # tip labels were saved in tree_info when download, no need to parse
+    # tree_taxa: tree key -> taxon from cache, new results are added
+    # if not compute, return None if any needed tree is not in tree_taxa
     taxon = ''
+    if tree_taxa is None:
+        tree_taxa = dict()
+    info_by_file = {i['tree_file']: i for i in record.tree_info}
     for tree_file in record.tree_files:
-        tree_file = fix_path(tree_file)
-        if not tree_file.exists():
+        info = info_by_file.get(tree_file, None)
+        key = get_tree_key(tree_file, info)
+        if not key:
             log.warning(f'{tree_file} not found')
             continue
-        with open(tree_file, 'r', encoding='utf-8', errors='ignore') as _:
-            # print(tree_file)
-            line = _.readline()
-            if line.startswith('#NEXUS'):
-                schema = 'nexus'
-            else:
-                schema = 'newick'
-            try:
-                tree = dendropy.Tree.get(path=tree_file, schema=schema)
-            except Exception:
-                log.warning(f'Invalid tree format {tree_file}')
-                return taxon
-            names = list()
-            for name in tree.taxon_namespace:
-                maybe_taxon_name = name.label.replace('_', ' ').split(' ')
-                names.extend(maybe_taxon_name)
-            taxon = get_taxon_by_names(maybe_taxon_name)
-            if taxon:
-                break
+        if key in tree_taxa:
+            tree_taxon = tree_taxa[key]
+        elif not compute:
+            return None
+        elif info is not None:
+            tree_taxon = get_taxon_by_labels(info['tip_labels'])
+            tree_taxa[key] = tree_taxon
+        else:
+            tree_taxon = get_tree_taxon(fix_path(tree_file))
+            tree_taxa[key] = tree_taxon
+        if tree_taxon is None:
+            return taxon
+        taxon = tree_taxon
+        if taxon:
+            break
     return taxon
 
 
-def assign_taxon(record: Result) -> (str, str):
-    text_taxon = assign_taxon_by_text(record)
-    tree_taxon = assign_taxon_by_tree(record)
+def get_kind(text_taxon: str, tree_taxon: str) -> (str, str):
     if (not text_taxon) and (not tree_taxon):
         lineage = ''
         kind = 'fail'
@@ -125,7 +202,7 @@ def assign_taxon(record: Result) -> (str, str):
         kind = 'by_tree'
     elif text_taxon and tree_taxon:
         lineage = text_taxon
-        if text_taxon == tree_taxon:
+        if is_same_lineage(text_taxon, tree_taxon):
             kind = 'both'
         else:
             # diffrent result from tree and text
@@ -135,13 +212,64 @@ def assign_taxon(record: Result) -> (str, str):
     return lineage, kind
 
 
-def wrap_for_parallel(result_json: Path) -> (int, int, list):
-    total_paper = 0
-    total_tree = 0
-    log.info(f'Process {result_json}')
+def assign_taxon(record: Result) -> (str, str):
+    text_taxon = assign_taxon_by_text(record)
+    tree_taxon = assign_taxon_by_tree(record)
+    return get_kind(text_taxon, tree_taxon)
+
+
+class TaxonCache:
+    # text and tree taxon of previous runs, appended to jsonl file
+    # the first line is version, old cache is dropped if vocabulary changed
+    def __init__(self, cache_file: Path, version: str):
+        self.cache_file = cache_file
+        self.version = version
+        self.data = dict()
+        if cache_file.exists():
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                head = f.readline()
+                if head.strip() and json.loads(head).get(
+                        'version', '') == version:
+                    for line in f:
+                        if line.strip():
+                            record = json.loads(line)
+                            self.data[record['key']] = record['value']
+                    return
+            log.info(f'Vocabulary changed, clear {cache_file}')
+        with open(cache_file, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'version': version}) + '\n')
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.data
+
+    def __getitem__(self, key: str):
+        return self.data[key]
+
+    def get(self, key: str, default=None):
+        return self.data.get(key, default)
+
+    def update(self, new: dict) -> None:
+        # only write new or changed items
+        lines = list()
+        for key, value in new.items():
+            if key in self.data and self.data[key] == value:
+                continue
+            self.data[key] = value
+            lines.append(json.dumps({'key': key, 'value': value}) + '\n')
+        if lines:
+            with open(self.cache_file, 'a', encoding='utf-8') as f:
+                f.writelines(lines)
+
+
+def get_cache_version() -> str:
+    return f'{CACHE_VERSION}:{get_vocabulary().version}'
+
+
+def read_records(result_json: Path) -> list[Result]:
+    # records with tree files
+    log.info(f'Read {result_json}')
     old_records = json.load(open(result_json, 'r'))
-    updated_record = list()
-    # new_result_file = result_json.with_suffix('.json.new2')
+    records = list()
     fields = {i.name for i in dataclasses.fields(Result)}
     # sometimes Result may have unwanted fields in kwargs
     for raw_record in old_records:
@@ -150,19 +278,63 @@ def wrap_for_parallel(result_json: Path) -> (int, int, list):
             if key not in fields:
                 raw_record.pop(key)
         record = Result(**raw_record)
-        if not record.tree_files:
-            continue
-        total_paper += 1
-        total_tree += len(record.tree_files)
-        lineage, kind = assign_taxon(record)
-        if kind == 'fail':
-            log.error(f'Cannot assign taxon to {record.doi}')
-        else:
-            log.info(f'Assign {lineage} to {record.doi} {kind}')
-        record.lineage = lineage
-        record.assign_type = kind
-        updated_record.append(record.to_dict())
-    return total_paper, total_tree, updated_record
+        if record.tree_files:
+            records.append(record)
+    return records
+
+
+def assign_taxon_chunk(jobs: list[tuple[Result, str | None, dict]]
+                       ) -> list[tuple[str, str, dict]]:
+    # run in worker, only send back taxon and new tree results
+    # job: record, cached text taxon or None, cached tree taxa
+    results = list()
+    for record, text_taxon, tree_taxa in jobs:
+        if text_taxon is None:
+            text_taxon = assign_taxon_by_text(record)
+        tree_taxon = assign_taxon_by_tree(record, tree_taxa)
+        results.append((text_taxon, tree_taxon, tree_taxa))
+    return results
+
+
+def iter_assigned(jobs: list, workers: int, chunk_size: int):
+    # yield (start, results) of each chunk once finished, in any order
+    # one big journal is split into many chunks, all workers keep busy
+    chunks = [(start, jobs[start:start+chunk_size])
+              for start in range(0, len(jobs), chunk_size)]
+    if workers <= 0:
+        for start, chunk in chunks:
+            yield start, assign_taxon_chunk(chunk)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(assign_taxon_chunk, chunk): start
+                   for start, chunk in chunks}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def get_cached_jobs(records: list[Result], cache: TaxonCache
+                    ) -> (int, list):
+    # assign records if all results are cached, return count and others
+    n_cached = 0
+    jobs = list()
+    for record in records:
+        text_taxon = cache.get(get_text_key(record), None)
+        info_by_file = {i['tree_file']: i for i in record.tree_info}
+        tree_taxa = dict()
+        for tree_file in record.tree_files:
+            key = get_tree_key(tree_file, info_by_file.get(tree_file, None))
+            if key in cache:
+                tree_taxa[key] = cache[key]
+        if text_taxon is not None:
+            tree_taxon = assign_taxon_by_tree(record, tree_taxa,
+                                              compute=False)
+            if tree_taxon is not None:
+                record.lineage, record.assign_type = get_kind(text_taxon,
+                                                              tree_taxon)
+                n_cached += 1
+                continue
+        jobs.append((record, text_taxon, tree_taxa))
+    return n_cached, jobs
 
 
 def remove_duplicate(filename):
@@ -182,22 +354,46 @@ def remove_duplicate(filename):
     return new_name
 
 
-def main():
+def main(workers=WORKERS, chunk_size=CHUNK_SIZE):
     # get_word_list()
     file_list = list(Path('.').glob('*.result.json.new'))
     # file_list = [Path(r'R:\paper.json')]
     assign_count = dict(fail=0, by_text=0, by_tree=0, both=0, by_text_bad=0)
     output = Path('assigned_taxon.json')
     # output = Path(r'R:\out.json')
-    new_records = list()
-    total_paper = 0
-    total_tree = 0
-    with ProcessPoolExecutor(max_workers=8) as executor:
-        for n_paper, n_tree, updated in executor.map(
-                wrap_for_parallel, file_list):
-            new_records.extend(updated)
-            total_paper += n_paper
-            total_tree += n_tree
+    records = list()
+    for result_json in file_list:
+        records.extend(read_records(result_json))
+    total_paper = len(records)
+    total_tree = sum(len(record.tree_files) for record in records)
+    check_lineage()
+    cache = TaxonCache(TAXON_CACHE, get_cache_version())
+    n_cached, jobs = get_cached_jobs(records, cache)
+    log.info(f'{n_cached} records assigned from cache')
+    log.info(f'Assign taxon to {len(jobs)} records with {workers} workers')
+    done = 0
+    for start, assigned in iter_assigned(jobs, workers, chunk_size):
+        new = dict()
+        for (record, *_), result in zip(jobs[start:start+len(assigned)],
+                                        assigned):
+            text_taxon, tree_taxon, tree_taxa = result
+            lineage, kind = get_kind(text_taxon, tree_taxon)
+            if kind == 'fail':
+                log.error(f'Cannot assign taxon to {record.doi}')
+            else:
+                log.info(f'Assign {lineage} to {record.doi} {kind}')
+            record.lineage = lineage
+            record.assign_type = kind
+            new[get_text_key(record)] = text_taxon
+            new.update(tree_taxa)
+        cache.update(new)
+        old_done = done
+        done += len(assigned)
+        if done // PROGRESS_SIZE != old_done // PROGRESS_SIZE or (
+                done == len(jobs)):
+            log.info(f'Assigned {done}/{len(jobs)} records')
+    # keep input order, remove_duplicate keeps the last one
+    new_records = [record.to_dict() for record in records]
     for _ in new_records:
         assign_count[_['assign_type']] += 1
     with open(output, 'w', encoding='utf-8') as f:
@@ -212,4 +408,8 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    # python output_tree_info_2.py [workers]
+    if len(sys.argv) > 1:
+        main(workers=int(sys.argv[1]))
+    else:
+        main()
\ No newline at end of file
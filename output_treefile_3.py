@@ -32,6 +32,9 @@ def main():
     trees = list()
     bad = list()
     good = 0
+    # tree files are deduplicated by content when downloaded, records may
+    # share one file, copy it only once
+    copied = dict()
     for doi in data:
         record = data[doi]
         # try to rename
@@ -47,6 +50,7 @@ def main():
         new_tree_files = list()
         merge[doi] = dict(record)
         merge[doi]['tree_files'] = list()
+        tree_info = {i['tree_file']: i for i in record.get('tree_info', [])}
         for n, tree_path in enumerate(record['tree_files']):
             tree_file = Path(tree_path)
             if not tree_file.exists():
@@ -60,15 +64,25 @@ def main():
             else:
                 description = ''
             name = tree_file.stem
-            _ = get_doi(doi, doi_type='folder')
-            new_filename = f'{_}_{n}_{good:06d}_{tree_file.name}'
+            if tree_file in copied:
+                new_filename = copied[tree_file]
+            else:
+                _ = get_doi(doi, doi_type='folder')
+                new_filename = f'{_}_{n}_{good:06d}_{tree_file.name}'
             t = Tree(root=record['lineage'], tree_title=name,
                      tree_label=description, tree_file=new_filename, doi=doi)
+            if tree_path in tree_info:
+                info = tree_info[tree_path]
+                t.schema = info['schema']
+                t.tree_count = info['tree_count']
+                t.tip_count = info['tip_count']
             new_file = out_path / new_filename
-            if new_file.exists():
-                print(new_file)
-                raise Exception
-            copyfile(tree_file, new_file)
+            if tree_file not in copied:
+                if new_file.exists():
+                    print(new_file)
+                    raise Exception
+                copyfile(tree_file, new_file)
+                copied[tree_file] = new_filename
             new_tree_files.append(str(new_file))
             t_dict = t.to_dict()
             trees.append(t_dict)
@@ -1,23 +1,43 @@
 import aiofile
 from Bio import Entrez
-from aiohttp import ClientSession
+from Bio.Entrez.Parser import CorruptedXMLError, NotXMLError
+from aiohttp import ClientError, ClientSession
 from calendar import month_abbr
+from collections import deque
 from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from typing import BinaryIO
+from xml.parsers.expat import ExpatError
 import asyncio
 import json
+import os
 
-from utils import Result
+from utils import Result, cached_request, retry_call, RetryableError, limiter
+from utils import check_status, PermanentError, CHUNK_SIZE
 
 BASE_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
 MONTH2NUM = {month_abbr[i]: f'{i:02d}' for i in range(1, 13)}
 # max fetch id number per request
 RETMAX = 10000
 # RETMAX = 1 # for test only
-# fetch article info per request
-BATCH_SIZE = 100
-# todo
-API_KEY = ''
+# fetch article info per request, use POST with history server
+BATCH_SIZE = 500
+# concurrent efetch requests, speed is limited by utils.limiter
+FETCH_WORKERS = 4
+# efetch response larger than this is kept on disk before parsing
+SPOOL_SIZE = 1024 * 1024 * 2
+API_KEY = os.environ.get('NCBI_API_KEY', '')
 Entrez.email = 'test@example.org'
+if API_KEY:
+    # 10 requests per second with api key
+    limiter.set_rate('eutils.ncbi.nlm.nih.gov', 10.0)
+
+
+def get_params(**kwargs) -> dict:
+    params = {'db': 'pubmed', **kwargs}
+    if API_KEY:
+        params['api_key'] = API_KEY
+    return params
 
 
 def get_journal_list() -> tuple:
@@ -35,6 +55,10 @@ def print2(data):
 
 
 def date2str(date_raw: dict) -> str:
+    if 'Year' not in date_raw and 'MedlineDate' in date_raw:
+        # like '1998 Dec-1999 Jan'
+        year = date_raw['MedlineDate'][:4]
+        return f'{year}/01/01'
     year = date_raw['Year']
     month = MONTH2NUM[date_raw.get('Month', 'Jan')]
     try:
@@ -53,27 +77,80 @@ def parse_entrez_result(data: bytes) -> dict:
     return parsed
 
 
+def iter_articles(handle: BinaryIO):
+    # yield PubmedArticle one by one instead of building whole result
+    # PubmedBookArticle is skipped
+    for record in Entrez.parse(handle):
+        if 'MedlineCitation' in record:
+            yield record
+
+
 async def fetch_id_list(session: ClientSession, query_str: str,
                         retmax: int) -> list:
     search_url = BASE_URL + 'esearch.fcgi'
-    params = {'db': 'pubmed', 'term': query_str, 'retmax': retmax}
-    async with session.get(search_url, params=params) as resp:
-        if not resp.ok:
-            return []
-        content = await resp.read()
-        parsed = parse_entrez_result(content)
-        return parsed['IdList']
+    params = get_params(term=query_str, retmax=retmax)
+    resp = await cached_request(session, 'GET', search_url, params=params,
+                                use_cache=False)
+    if not resp.ok:
+        return []
+    parsed = parse_entrez_result(resp.body)
+    return parsed['IdList']
 
 
-async def fetch_article_info(session: ClientSession, id_list: str) -> dict:
+async def search_history(session: ClientSession, query_str: str
+                         ) -> (int, str, str):
+    # store search result in history server, return count, WebEnv, query_key
+    search_url = BASE_URL + 'esearch.fcgi'
+    data = get_params(term=query_str, usehistory='y', retmax=0)
+    resp = await cached_request(session, 'POST', search_url, data=data,
+                                use_cache=False)
+    if not resp.ok:
+        return 0, '', ''
+    parsed = parse_entrez_result(resp.body)
+    return int(parsed['Count']), parsed['WebEnv'], parsed['QueryKey']
+
+
+async def fetch_article_info(session: ClientSession, id_list: str = '',
+                             webenv: str = '', query_key: str = '',
+                             retstart=0, retmax=BATCH_SIZE) -> list[Result]:
+    # fetch by id list, or by WebEnv and query_key from search_history
+    # response is spooled by chunk, then parsed article by article
     fetch_url = BASE_URL + 'efetch.fcgi'
-    params = {'db': 'pubmed', 'id': id_list}
-    async with session.get(fetch_url, params=params) as resp:
-        if not resp.ok:
-            return {}
-        content = await resp.read()
-        parsed = parse_entrez_result(content)
-    return parsed['PubmedArticle']
+    if webenv:
+        data = get_params(WebEnv=webenv, query_key=query_key,
+                          retstart=retstart, retmax=retmax, retmode='xml')
+    else:
+        data = get_params(id=id_list)
+
+    async def fetch_and_parse() -> list[Result]:
+        with SpooledTemporaryFile(max_size=SPOOL_SIZE) as tmp:
+            await limiter.wait(fetch_url)
+            async with session.post(fetch_url, data=data) as resp:
+                check_status(resp.status, resp.headers, fetch_url)
+                async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                    tmp.write(chunk)
+            tmp.seek(0)
+            results = list()
+            articles = iter_articles(tmp)
+            while True:
+                # truncated xml, fetch again
+                try:
+                    article = next(articles, None)
+                except (CorruptedXMLError, NotXMLError, ExpatError) as e:
+                    raise RetryableError(f'Bad efetch result {e!r}')
+                if article is None:
+                    break
+                # unexpected data of one article, skip it
+                try:
+                    results.append(parse_article_info(article))
+                except Exception as e:
+                    pmid = article['MedlineCitation'].get('PMID', '')
+                    print(f'Skip article {pmid} {e!r}')
+            return results
+
+    # errors after retries are raised, caller decides what to do with the
+    # missing batch
+    return await retry_call(fetch_and_parse)
 
 
 def parse_article_info(info: dict) -> Result:
@@ -112,32 +189,68 @@ async def main(start_date: str, end_date: str, journal: str):
     ("{start_date}"[Date - Publication] : "{end_date}"[Date - Publication])''')
     session = ClientSession()
     print(query_str)
-    id_list = await fetch_id_list(session, query_str, retmax=RETMAX)
-    result_list = list()
-    print(len(id_list), 'records')
-    for i in range(0, len(id_list), BATCH_SIZE):
-        batch_id_list = ','.join(id_list[i:(i + BATCH_SIZE)])
-        # NCBI limit 3 requests per second
-        while True:
-            print('\t', i, i + BATCH_SIZE)
-            await asyncio.sleep(0.3)
-            try:
-                batch_article_info = await fetch_article_info(session, batch_id_list)
-                break
-            except Exception as e:
-                print(e)
-                pass
-        for record in batch_article_info:
-            article_info = parse_article_info(record)
-            print('\t', article_info.doi)
-            result_list.append(article_info.to_dict())
-    # output
+    count, webenv, query_key = await search_history(session, query_str)
+    print(count, 'records')
     out_file = (start_date.replace('/', '') + '-' +
                 end_date.replace('/', '') + '-' +
                 journal.replace(' ', '_') + '.json')
+
+    # retstart of batches still fail after retries
+    failed = list()
+
+    async def fetch_batch(retstart: int) -> list[Result]:
+        print('\t', retstart, retstart + BATCH_SIZE)
+        try:
+            return await fetch_article_info(session, webenv=webenv,
+                                            query_key=query_key,
+                                            retstart=retstart)
+        except (PermanentError, RetryableError, ClientError,
+                asyncio.TimeoutError) as e:
+            print(f'Batch {retstart} fail {e!r}')
+            failed.append(retstart)
+            return []
+
+    # at most FETCH_WORKERS batches in memory, write records in batch order
+    # as soon as they are ready
+    batch_starts = iter(range(0, count, BATCH_SIZE))
+    pending = deque()
+    for retstart in batch_starts:
+        pending.append(asyncio.create_task(fetch_batch(retstart)))
+        if len(pending) >= FETCH_WORKERS:
+            break
+    first = True
     async with aiofile.async_open(out_file, 'w', encoding='utf-8') as out:
-        await out.write(json.dumps(result_list))
+
+        async def write_batch(batch_: list[Result]) -> None:
+            nonlocal first
+            for article_info in batch_:
+                print('\t', article_info.doi)
+                if not first:
+                    await out.write(', ')
+                first = False
+                await out.write(json.dumps(article_info.to_dict()))
+
+        await out.write('[')
+        while pending:
+            batch = await pending.popleft()
+            retstart = next(batch_starts, None)
+            if retstart is not None:
+                pending.append(asyncio.create_task(fetch_batch(retstart)))
+            await write_batch(batch)
+        # try failed batches again after others are done
+        retry_starts = failed.copy()
+        failed.clear()
+        for retstart in retry_starts:
+            await write_batch(await fetch_batch(retstart))
+        await out.write(']')
     await session.close()
+    if failed:
+        # keep what we got, but do not let it be read as complete result
+        incomplete = out_file + '.incomplete'
+        os.replace(out_file, incomplete)
+        print(f'Batches {sorted(failed)} of {journal} failed, output file '
+              f'{incomplete} is incomplete')
+        return
     print('Output file', out_file)
     return
 
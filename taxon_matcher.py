@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+# match order/family/genus names in text with one scan
+# one word names are looked up in given vocabularies directly, other names
+# are tokenized into words and stored by words joined with blank, with the max
+# word count of names starting with each word, so multi-word names like
+# 'Candidatus Xenobiaceales' are matched as well
+# no per name structure is built for 100k one word names, so it is cheap to
+# build in each worker
+from dataclasses import dataclass
+from typing import Collection, Iterable
+import re
+
+WORD_PATTERN = re.compile(r'\w+')
+# higher rank first
+RANKS = ('order', 'family', 'genus')
+
+
+@dataclass(frozen=True)
+class Hit:
+    rank: str
+    name: str
+    # position in scanned text
+    start: int
+    end: int
+
+
+class TaxonMatcher:
+    def __init__(self, vocabularies: dict[str, Collection[str]],
+                 stop_words: Iterable[str] = (),
+                 phrases: dict[str, Iterable[str]] | None = None):
+        # vocabularies: rank -> names (set or dict), rank should be in RANKS
+        # stop_words: capitalized common words, skipped if name is one word
+        # phrases: rank -> names not one word, found from vocabularies if
+        # not given
+        self.stop_words = frozenset(stop_words)
+        self.rank_index = {rank: n for n, rank in enumerate(RANKS)}
+        # higher rank first
+        self.vocabularies = sorted(vocabularies.items(),
+                                   key=lambda x: self.rank_index[x[0]])
+        # words joined by blank -> (rank, name), for names not one word
+        self.phrases = dict()
+        # first word -> max word count
+        self.lengths = dict()
+        if phrases is None:
+            phrases = {rank: [i for i in names if not i.isalnum()]
+                       for rank, names in self.vocabularies}
+        for rank, names in phrases.items():
+            for name in names:
+                self.add(name, rank)
+
+    def add(self, name: str, rank: str) -> None:
+        words = WORD_PATTERN.findall(name)
+        if not words:
+            return
+        key = ' '.join(words)
+        old = self.phrases.get(key, None)
+        # same name in different rank, keep the higher one
+        if old is None or self.rank_index[rank] < self.rank_index[old[0]]:
+            self.phrases[key] = (rank, name)
+        if len(words) > self.lengths.get(words[0], 1):
+            self.lengths[words[0]] = len(words)
+
+    def lookup(self, key: str) -> tuple[str, str] | None:
+        # (rank, name) of the highest rank, or None
+        found = self.phrases.get(key, None)
+        for rank, names in self.vocabularies:
+            # same rank, the exact name wins
+            if found is not None and (self.rank_index[found[0]] <
+                                      self.rank_index[rank]):
+                break
+            if key in names:
+                return rank, key
+        return found
+
+    def scan(self, text: str) -> list[Hit]:
+        # return all hits, sorted by rank then position
+        if not text:
+            return []
+        tokens = [(m.group(), m.start(), m.end())
+                  for m in WORD_PATTERN.finditer(text)]
+        hits = list()
+        n_token = len(tokens)
+        for i, (word, start, end) in enumerate(tokens):
+            # same rule as old get_words
+            if len(word) < 2 or not word[0].isupper():
+                continue
+            length = self.lengths.get(word, 1)
+            for n in range(1, min(length, n_token - i) + 1):
+                if n == 1:
+                    if word in self.stop_words:
+                        continue
+                    key = word
+                else:
+                    key = ' '.join([j[0] for j in tokens[i:i+n]])
+                found = self.lookup(key)
+                if found is not None:
+                    rank, name = found
+                    hits.append(Hit(rank, name, start, tokens[i+n-1][2]))
+        hits.sort(key=lambda x: (self.rank_index[x.rank], x.start))
+        return hits
+
+    def match(self, text: str) -> str:
+        # highest rank, first appeared name, or ''
+        hits = self.scan(text)
+        if hits:
+            return hits[0].name
+        return ''
+
+    def match_batch(self, texts: Iterable[str]) -> list[str]:
+        return [self.match(text) for text in texts]
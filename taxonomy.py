@@ -0,0 +1,325 @@
+#!/usr/bin/python3
+# compile taxon name lists in data/ into one binary snapshot
+# each vocabulary is a sorted array of utf-8 names with an offset table,
+# names are separated by newline so that a whole vocabulary is decoded by one
+# call, each process builds its list and dict once when first used, much
+# faster than reading and cleaning csv
+# genus->family and family->order are int arrays of ids (index in sorted
+# names), -1 if unknown, from optional data/lineage.csv (genus,family,order)
+# snapshot is rebuilt when any csv changed
+# usage: python taxonomy.py  (build snapshot)
+from array import array
+from functools import lru_cache
+from hashlib import sha1
+from pathlib import Path
+from typing import Iterable
+import csv
+import json
+import mmap
+import os
+import sys
+
+DATA_FOLDER = Path('data')
+SNAPSHOT = DATA_FOLDER / 'vocabulary.snapshot'
+MAGIC = b'TAXSNAP4\n'
+# vocabulary name -> source files
+SOURCES = {
+    # from barcodefinder
+    # https://www.ef.edu/english-resources/english-vocabulary/top-1000-words/
+    'english': ('1000_frequent_words .txt',),
+    'genus': ('genus.csv',),
+    'family': ('other_families.csv', 'plant_families.csv'),
+    'order': ('animal_orders.csv', 'other_orders.csv'),
+}
+# optional, one genus per row: genus,family,order, empty if unknown
+LINEAGE = 'lineage.csv'
+# vocabulary -> section of names not one word
+PHRASES = {'genus': 'genus_phrases', 'family': 'family_phrases',
+           'order': 'order_phrases'}
+# parent array name -> (child, parent)
+PARENTS = {'genus_family': ('genus', 'family'),
+           'family_order': ('family', 'order')}
+
+
+def get_signature() -> dict:
+    # size and mtime of source files, snapshot is outdated if changed
+    signature = dict()
+    for files in SOURCES.values():
+        for filename in files:
+            stat = (DATA_FOLDER / filename).stat()
+            signature[filename] = [stat.st_size, stat.st_mtime_ns]
+    lineage = DATA_FOLDER / LINEAGE
+    if lineage.exists():
+        stat = lineage.stat()
+        signature[LINEAGE] = [stat.st_size, stat.st_mtime_ns]
+    else:
+        signature[LINEAGE] = None
+    return signature
+
+
+def read_names(name: str) -> set[str]:
+    names = set()
+    for filename in SOURCES[name]:
+        with open(DATA_FOLDER / filename, 'r') as _:
+            names.update(_.read().strip().split(','))
+    if name == 'english':
+        names = {word.capitalize() for word in names}
+    names.discard('')
+    return names
+
+
+def read_lineage() -> list[tuple[str, str, str]]:
+    rows = list()
+    lineage = DATA_FOLDER / LINEAGE
+    if not lineage.exists():
+        return rows
+    with open(lineage, 'r', encoding='utf-8', newline='') as _:
+        for row in csv.reader(_):
+            row = [i.strip() for i in row[:3]]
+            if len(row) < 3 or row[0].lower() == 'genus':
+                continue
+            rows.append(tuple(row))
+    return rows
+
+
+class SortedWords:
+    # read only set of names in snapshot, lookup by binary search
+    # for many lookups, use Vocabulary.get_set instead
+    def __init__(self, buffer: mmap.mmap, offsets: memoryview, start: int):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.start = start
+        self.count = len(offsets) - 1
+
+    def _get(self, i: int) -> bytes:
+        # remove newline
+        return self.buffer[self.start + self.offsets[i]:
+                           self.start + self.offsets[i+1] - 1]
+
+    def index(self, word: str) -> int:
+        # id of word, -1 if not found
+        key = word.encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self._get(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.count and self._get(low) == key:
+            return low
+        return -1
+
+    def __contains__(self, word: str) -> bool:
+        return self.index(word) != -1
+
+    def __getitem__(self, i: int) -> str:
+        return self._get(i).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self._get(i).decode('utf-8')
+
+    def __len__(self) -> int:
+        return self.count
+
+    def to_list(self) -> list[str]:
+        end = self.start + self.offsets[self.count]
+        return self.buffer[self.start:end].decode('utf-8').split('\n')[:-1]
+
+
+class Vocabulary:
+    # english, genus, family, order and their PHRASES are SortedWords
+    # genus_family and family_order are parent ids
+    def __init__(self, snapshot: Path, header: dict):
+        with open(snapshot, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.buffer)
+        for name, (offset_start, count, blob_start) in header[
+                'sections'].items():
+            offsets = view[offset_start:offset_start+4*(count+1)].cast('I')
+            setattr(self, name, SortedWords(self.buffer, offsets, blob_start))
+        for name, (start, count) in header['parents'].items():
+            setattr(self, name, view[start:start+4*count].cast('i'))
+        # changes when any source file changed, for caches of results
+        self.version = sha1(json.dumps(header['signature'], sort_keys=True
+                                       ).encode('utf-8')).hexdigest()
+        # number of known parents in genus_family and family_order
+        self.lineage_count = header['lineage_count']
+        # built in each process when first used
+        self._words = dict()
+        self._sets = dict()
+        self._ids = dict()
+
+    def get_words(self, name: str) -> list[str]:
+        # sorted names, id is the index
+        if name not in self._words:
+            self._words[name] = getattr(self, name).to_list()
+        return self._words[name]
+
+    def get_set(self, name: str) -> frozenset[str]:
+        # for fast lookup in hot path
+        if name not in self._sets:
+            self._sets[name] = frozenset(getattr(self, name).to_list())
+        return self._sets[name]
+
+    def get_ids(self, name: str) -> dict[str, int]:
+        # name -> id
+        if name not in self._ids:
+            words = self.get_words(name)
+            self._ids[name] = dict(zip(words, range(len(words))))
+        return self._ids[name]
+
+    def get_lineage(self, name: str) -> list[str]:
+        # name and its known parents, lower rank first
+        if self.lineage_count == 0:
+            if any(name in self.get_set(i) for i in ('genus', 'family',
+                                                     'order')):
+                return [name]
+            return []
+        lineage = list()
+        genus_id = self.get_ids('genus').get(name, -1)
+        family_id = self.get_ids('family').get(name, -1)
+        order_id = self.get_ids('order').get(name, -1)
+        if genus_id != -1:
+            lineage.append(name)
+            family_id = self.genus_family[genus_id]
+        if family_id != -1:
+            lineage.append(self.get_words('family')[family_id])
+            order_id = self.family_order[family_id]
+        if order_id != -1:
+            lineage.append(self.get_words('order')[order_id])
+        return lineage
+
+    def get_common_ancestor(self, genus_names: Iterable[str]) -> str:
+        # lowest common genus/family/order of given genera, one pass on ids
+        # return '' if no genus found or any parent is unknown
+        if self.lineage_count == 0:
+            # no lineage, skip building ids
+            genus_set = self.get_set('genus')
+            names = {i for i in genus_names if i in genus_set}
+            if len(names) == 1:
+                return names.pop()
+            return ''
+        ids = self.get_ids('genus')
+        genus_ids = {ids.get(i, -1) for i in genus_names}
+        genus_ids.discard(-1)
+        if not genus_ids:
+            return ''
+        if len(genus_ids) == 1:
+            return self.get_words('genus')[genus_ids.pop()]
+        family_ids = {self.genus_family[i] for i in genus_ids}
+        if -1 in family_ids:
+            return ''
+        if len(family_ids) == 1:
+            return self.get_words('family')[family_ids.pop()]
+        order_ids = {self.family_order[i] for i in family_ids}
+        if -1 in order_ids or len(order_ids) != 1:
+            return ''
+        return self.get_words('order')[order_ids.pop()]
+
+
+def read_header(snapshot: Path) -> dict | None:
+    # return None if snapshot is missing or outdated
+    if not snapshot.exists():
+        return None
+    with open(snapshot, 'rb') as f:
+        if f.readline() != MAGIC:
+            return None
+        header = json.loads(f.readline())
+    if header['byteorder'] != sys.byteorder:
+        return None
+    try:
+        signature = get_signature()
+    except FileNotFoundError:
+        # csv removed, use snapshot as is
+        return header
+    if header['signature'] != signature:
+        return None
+    return header
+
+
+def build_snapshot(snapshot=SNAPSHOT) -> Path:
+    sections = dict()
+    data = list()
+    # magic and header length are unknown, put data after a fixed header size
+    header_size = 4096
+    position = header_size
+    ids = dict()
+    vocabularies = dict()
+    for name in SOURCES:
+        names = read_names(name)
+        vocabularies[name] = names
+        if name in PHRASES:
+            # names not one word, for TaxonMatcher
+            vocabularies[PHRASES[name]] = {i for i in names
+                                           if not i.isalnum()}
+    for name, names in vocabularies.items():
+        words = sorted(i.encode('utf-8') for i in names)
+        ids[name] = {word.decode('utf-8'): n for n, word in enumerate(words)}
+        offsets = array('I', [0])
+        for word in words:
+            offsets.append(offsets[-1] + len(word) + 1)
+        blob = b''.join(word + b'\n' for word in words)
+        offset_start = position
+        blob_start = offset_start + len(offsets) * offsets.itemsize
+        sections[name] = [offset_start, len(words), blob_start]
+        data.extend([offsets.tobytes(), blob])
+        position = blob_start + len(blob)
+        # keep offset table aligned
+        padding = -position % 4
+        data.append(b'\0' * padding)
+        position += padding
+    parent_arrays = {name: array('i', [-1]) * len(ids[child])
+                     for name, (child, _) in PARENTS.items()}
+    for row in read_lineage():
+        lineage = dict(zip(('genus', 'family', 'order'), row))
+        for name, (child, parent) in PARENTS.items():
+            child_id = ids[child].get(lineage[child], -1)
+            parent_id = ids[parent].get(lineage[parent], -1)
+            if child_id != -1 and parent_id != -1:
+                parent_arrays[name][child_id] = parent_id
+    parents = dict()
+    lineage_count = 0
+    for name, parent_array in parent_arrays.items():
+        lineage_count += len(parent_array) - parent_array.count(-1)
+        parents[name] = [position, len(parent_array)]
+        data.append(parent_array.tobytes())
+        position += len(parent_array) * parent_array.itemsize
+    header = json.dumps({'signature': get_signature(),
+                         'byteorder': sys.byteorder,
+                         'sections': sections,
+                         'parents': parents,
+                         'lineage_count': lineage_count}).encode('utf-8')
+    header += b'\n'
+    head = MAGIC + header
+    if len(head) > header_size:
+        raise ValueError('Snapshot header too long')
+    tmp = snapshot.with_suffix('.tmp')
+    with open(tmp, 'wb') as out:
+        out.write(head.ljust(header_size, b'\0'))
+        for i in data:
+            out.write(i)
+    os.replace(tmp, snapshot)
+    return snapshot
+
+
+@lru_cache(maxsize=None)
+def get_vocabulary() -> Vocabulary:
+    # load on first use, build if missing or outdated
+    header = read_header(SNAPSHOT)
+    if header is None:
+        build_snapshot()
+        header = read_header(SNAPSHOT)
+    return Vocabulary(SNAPSHOT, header)
+
+
+if __name__ == '__main__':
+    out = build_snapshot()
+    print('Write snapshot', out)
+    count = read_header(out)['lineage_count']
+    if count == 0:
+        print(f'Warning: no lineage found in {DATA_FOLDER / LINEAGE}, '
+              f'common ancestor is disabled')
+    else:
+        print(f'{count} lineage links')
@@ -1,16 +1,36 @@
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import asdict, dataclass
-from io import BytesIO
+from io import BufferedReader, BytesIO, FileIO, StringIO, TextIOWrapper
+from itertools import chain
 from pathlib import Path
+from shutil import copyfileobj
+from tempfile import SpooledTemporaryFile, mkstemp
+from typing import BinaryIO, Iterable
 from zipfile import ZipFile, BadZipfile
+from email.utils import parsedate_to_datetime
+from hashlib import sha1, sha256
+from random import uniform
+from time import monotonic, time
+from urllib.parse import urlparse
 import asyncio
 import json
 import logging
+import os
 import re
 
 import aiohttp
 import dendropy
 
 MAX_SIZE = 1024 * 1024 * 100
+# streaming download, write chunks to disk
+CHUNK_SIZE = 1024 * 64
+# processes for zip extraction and tree validation, 0 to run in event loop
+PROCESS_WORKERS = os.cpu_count() or 1
+# zip member smaller than this is checked in memory before written
+MEMORY_CHECK_SIZE = 1024 * 1024 * 32
+# nested zip depth and total uncompressed size of one downloaded zip
+MAX_ZIP_DEPTH = 3
+MAX_UNZIP_SIZE = 1024 * 1024 * 1024 * 2
 proxy = 'http://127.0.0.1:7890'
 
 NEXUS_SUFFIX = set('.nex,.nexus'.split(','))
@@ -18,14 +38,353 @@ TREE_SUFFIX = set('.nwk,.newick,.nex,.nexus,.tre,.tree,.treefile'.split(','))
 TXT_SUFFIX = {'.txt'}
 ZIP_SUFFIX = {'.zip'}
 TARGET_SUFFIX = TREE_SUFFIX | ZIP_SUFFIX | TXT_SUFFIX | NEXUS_SUFFIX
+NEXUS_TREES_PATTERN = re.compile(r'begin\s+trees\s*;', re.IGNORECASE)
+# first two words of statement
+COMMAND_PATTERN = re.compile(r'\s*([^\s=]+)\s*([^\s=]*)')
+COMMENT_PATTERN = re.compile(r'\[[^\]]*\]')
+# quoted label, comment, punctuation or unquoted word
+TOKEN_PATTERN = re.compile(r"'(?:[^']|'')*'|\[[^\]]*\]|[(),:;=]|"
+                           r"[^\s(),:;=\[\]']+")
+# text till ';' outside quoted label
+STATEMENT_PATTERN = re.compile(r"(?:[^';]|'(?:[^']|'')*')*;")
+# label at start of tree or after '(' or ','
+TIP_PATTERN = re.compile(r"(?:^|[(,])\s*('(?:[^']|'')*'|[^\s(),:;=\[\]']+)")
+# file with more trees is regarded as posterior sample
+POSTERIOR_MIN_TREES = 100
+MAX_TIP_LABELS = 10000
+# requests per second of each API host, shared by all client functions
+# dryad: 120/min, crossref: 50/s, ncbi: 3/s without api key, 10/s with key
+RATE_LIMITS = {'datadryad.org': 2.0,
+               'api.figshare.com': 5.0,
+               'api.crossref.org': 50.0,
+               'eutils.ncbi.nlm.nih.gov': 3.0}
+# cache of search and metadata API responses
+CACHE_FOLDER = Path('http_cache').absolute()
+CACHE_TTL = 3600 * 24 * 30
+CACHE_MAX_SIZE = 1024 * 1024 * 512
 OUT_FOLDER = Path(r'R:\tree_crawl_out').absolute()
 # OUT_FOLDER = Path('/Users/wuping/Ramdisk/trees').absolute()
 if not OUT_FOLDER.exists():
     OUT_FOLDER.mkdir()
+# content hash of tree files to path of first copy
+TREE_INDEX = OUT_FOLDER / 'tree_index.jsonl'
+# unfinished downloads, resume by Range request
+PARTIAL_FOLDER = OUT_FOLDER.with_name(OUT_FOLDER.name + '_partial')
 
 log = logging.getLogger('fetch_tree')
 
 
+class RetryableError(Exception):
+    # temporary failure, retry_after is seconds from Retry-After header
+    def __init__(self, msg: str, retry_after: float | None = None,
+                 response=None):
+        super().__init__(msg)
+        self.retry_after = retry_after
+        self.response = response
+
+
+class PermanentError(Exception):
+    # do not retry, such as 403, 404 or too big file
+    pass
+
+
+class TooBigError(PermanentError):
+    pass
+
+
+class UnauthorizedError(PermanentError):
+    # 401, caller may refresh token and try again
+    pass
+
+
+class RetryPolicy:
+    # exponential backoff with full jitter, Retry-After wins if provided
+    def __init__(self, tries=5, base=1.0, cap=60.0, max_retry_after=600.0):
+        self.tries = tries
+        self.base = base
+        self.cap = cap
+        self.max_retry_after = max_retry_after
+
+    def delay(self, attempt: int, retry_after: float | None = None) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        return uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+DEFAULT_RETRY = RetryPolicy()
+DOWNLOAD_RETRY = RetryPolicy(tries=10)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    # Retry-After could be seconds or http date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable_status(status: int) -> bool:
+    # 4xx are permanent except timeout and rate limit
+    return status >= 500 or status in (408, 425, 429)
+
+
+def check_status(status: int, headers, url: str, response=None) -> None:
+    # raise error according to status, do nothing if ok
+    if status < 400:
+        return
+    if is_retryable_status(status):
+        retry_after = None
+        if status in (429, 503):
+            retry_after = parse_retry_after(headers.get('Retry-After', None))
+        raise RetryableError(f'{url} {status}', retry_after, response)
+    if status == 401:
+        raise UnauthorizedError(f'{url} {status}')
+    raise PermanentError(f'{url} {status}')
+
+
+async def retry_call(func, *args, policy=DEFAULT_RETRY, **kwargs):
+    # call async func, retry on RetryableError and network errors
+    for attempt in range(policy.tries):
+        try:
+            return await func(*args, **kwargs)
+        except (RetryableError, aiohttp.ClientError, asyncio.TimeoutError,
+                ConnectionError) as e:
+            if attempt + 1 >= policy.tries:
+                raise
+            wait = policy.delay(attempt, getattr(e, 'retry_after', None))
+            log.warning(f'{e!r}, retry in {wait:.1f}s '
+                        f'({attempt+1}/{policy.tries})')
+            await asyncio.sleep(wait)
+
+
+class TokenBucket:
+    # allow burst of capacity requests, then refill by rate per second
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = monotonic()
+        self._lock = None
+        self._loop = None
+
+    def _get_lock(self) -> asyncio.Lock:
+        # scripts call asyncio.run() many times, lock is bound to one loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    async def acquire(self) -> None:
+        async with self._get_lock():
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+class RateLimiter:
+    # one token bucket per host, unknown hosts are not limited
+    def __init__(self, limits: dict[str, float]):
+        self.buckets = dict()
+        for host, rate in limits.items():
+            self.set_rate(host, rate)
+
+    def set_rate(self, host: str, rate: float, capacity: float = 1.0):
+        self.buckets[host] = TokenBucket(rate, capacity)
+
+    async def wait(self, url: str) -> None:
+        host = urlparse(url).hostname
+        bucket = self.buckets.get(host, None)
+        if bucket is not None:
+            await bucket.acquire()
+
+
+limiter = RateLimiter(RATE_LIMITS)
+
+
+@dataclass
+class CachedResponse:
+    status: int
+    headers: dict
+    body: bytes
+
+    @property
+    def ok(self) -> bool:
+        return self.status < 400
+
+    def text(self) -> str:
+        return self.body.decode('utf-8', errors='ignore')
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class ResponseCache:
+    # one json file per request, key is method, url and params
+    # headers are not in key since dryad token changes
+    # ttl is checked against fetch time stored in the file, mtime is only for
+    # lru order since it is updated on every hit
+    # expired files and least recently used files beyond max_size are removed
+    # 404 is cached too because missing doi do not come back
+    cacheable = {200, 404}
+
+    def __init__(self, folder: Path, ttl=CACHE_TTL, max_size=CACHE_MAX_SIZE,
+                 evict_every=200):
+        self.folder = folder
+        self.ttl = ttl
+        self.max_size = max_size
+        self.evict_every = evict_every
+        self.n_write = 0
+
+    def get_path(self, method: str, url: str, params: dict | None,
+                 data: dict | None) -> Path:
+        key = json.dumps([method.upper(), url, params, data], sort_keys=True,
+                         default=str)
+        return self.folder / (sha256(key.encode()).hexdigest() + '.json')
+
+    def get(self, path: Path) -> CachedResponse | None:
+        try:
+            raw = json.loads(path.read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            path.unlink(missing_ok=True)
+            return None
+        # old files without fetch time are treated as expired
+        if time() - raw.get('fetched', 0) > self.ttl:
+            path.unlink(missing_ok=True)
+            return None
+        # mark as recently used
+        os.utime(path)
+        return CachedResponse(raw['status'], raw['headers'],
+                              raw['body'].encode('utf-8'))
+
+    def put(self, path: Path, response: CachedResponse) -> None:
+        raw = {'status': response.status, 'headers': response.headers,
+               'body': response.text(), 'fetched': time()}
+        self.folder.mkdir(parents=True, exist_ok=True)
+        # unique name, same request may be written by several workers
+        fd, tmp = mkstemp(suffix='.tmp', prefix=path.stem, dir=self.folder)
+        with open(fd, 'w', encoding='utf-8') as out:
+            out.write(json.dumps(raw))
+        os.replace(tmp, path)
+        self.n_write += 1
+        if self.n_write % self.evict_every == 0:
+            self.evict()
+
+    def evict(self) -> None:
+        now = time()
+        files = list()
+        total = 0
+        for path in self.folder.glob('*.json'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            # fetch time <= mtime, so old mtime means expired, others are
+            # checked in get()
+            if now - stat.st_mtime > self.ttl:
+                path.unlink(missing_ok=True)
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+        log.debug(f'Response cache {total} bytes')
+
+
+response_cache = ResponseCache(CACHE_FOLDER)
+
+
+async def cached_request(session: aiohttp.ClientSession, method: str,
+                         url: str, params=None, data=None, use_cache=True,
+                         policy=DEFAULT_RETRY, **kwargs) -> CachedResponse:
+    # send request unless cached, rate limit only apply to real requests
+    # temporary errors are retried, other bad status are returned as is
+    path = response_cache.get_path(method, url, params, data)
+    if use_cache:
+        cached = response_cache.get(path)
+        if cached is not None:
+            log.debug(f'Cache hit {url} {params}')
+            return cached
+
+    async def send() -> CachedResponse:
+        await limiter.wait(url)
+        async with session.request(method, url, params=params, data=data,
+                                   **kwargs) as resp:
+            body = await resp.read()
+            response_ = CachedResponse(resp.status, dict(resp.headers), body)
+        if is_retryable_status(response_.status):
+            check_status(response_.status, response_.headers, url, response_)
+        return response_
+
+    try:
+        response = await retry_call(send, policy=policy)
+    except RetryableError as e:
+        if e.response is None:
+            raise
+        response = e.response
+    if use_cache and response.status in response_cache.cacheable:
+        response_cache.put(path, response)
+    return response
+
+
+class DownloadedFile(BufferedReader):
+    # finished download in PARTIAL_FOLDER, removed when closed
+    # lock of the url is released after removed
+    def __init__(self, path: Path):
+        super().__init__(FileIO(path, 'rb'))
+        self.path = path
+        self.lock = None
+
+    def close(self):
+        super().close()
+        self.path.unlink(missing_ok=True)
+        self.path.with_suffix('.meta').unlink(missing_ok=True)
+        if self.lock is not None:
+            lock, self.lock = self.lock, None
+            lock.release()
+
+
+class DownloadLocks:
+    # one lock per url, same url share the same partial file, so download of
+    # it must wait until the previous file was used and removed
+    def __init__(self):
+        self.locks = dict()
+        self._loop = None
+
+    def get(self, url: str) -> asyncio.Lock:
+        # scripts call asyncio.run() many times, lock is bound to one loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self.locks = dict()
+        if url not in self.locks:
+            self.locks[url] = asyncio.Lock()
+        return self.locks[url]
+
+
+download_locks = DownloadLocks()
+
+
 @dataclass
 class Tree:
     # unlike Trees in databases.py
@@ -45,12 +404,43 @@ class Tree:
     # should check if exists, rename
     tree_file: str = ''
     doi: str = ''
+    # from TreeInfo
+    schema: str = ''
+    tree_count: int = 0
+    tip_count: int = 0
 
 
     def to_dict(self):
         return asdict(self)
 
 
+@dataclass
+class TreeInfo:
+    # info of one tree file, from validation
+    tree_file: str = ''
+    # newick/nexus
+    schema: str = ''
+    tree_count: int = 0
+    # single/multiple/posterior
+    kind: str = ''
+    # from the first tree
+    tip_count: int = 0
+    # labels in taxon namespace, at most MAX_TIP_LABELS
+    tip_labels: tuple[str] = tuple()
+    # sha1 of all sorted labels
+    label_digest: str = ''
+
+    def to_dict(self):
+        return asdict(self)
+
+    def add_tree(self, tree: dendropy.Tree) -> None:
+        labels = [i.label for i in tree.taxon_namespace if i.label]
+        self.tip_count = len(tree.leaf_nodes())
+        self.tip_labels = tuple(labels[:MAX_TIP_LABELS])
+        self.label_digest = sha1('\n'.join(sorted(labels)).encode()
+                                 ).hexdigest()
+
+
 @dataclass
 class Result:
     abstract: str = ''
@@ -67,6 +457,8 @@ class Result:
     lineage: str = ''
     tree_files: tuple[str] = tuple()
     assign_type: str = ''
+    # TreeInfo dict of each tree file
+    tree_info: tuple[dict] = tuple()
 
     def __hash__(self):
         return hash(self.doi)
@@ -74,9 +466,9 @@ class Result:
     def empty(self):
         return len(self.tree_files) == 0
 
-    # todo: add tree content and info
-    def add_trees(self, trees: list[Path]):
-        self.tree_files = tuple([str(i) for i in trees])
+    def add_trees(self, trees: list[TreeInfo]):
+        self.tree_files = tuple([i.tree_file for i in trees])
+        self.tree_info = tuple([i.to_dict() for i in trees])
 
     def have_tree(self):
         return len(self.tree_files) > 0
@@ -110,107 +502,523 @@ def get_doi(raw_doi: str, doi_type='default') -> str:
 
 
 async def download(session: aiohttp.ClientSession, download_url: str,
-                   size: int, headers: dict) -> (bool, bytes):
+                   size: int, headers: dict, stream=False,
+                   policy=DOWNLOAD_RETRY, refresh=None
+                   ) -> (bool, bytes | BinaryIO):
+    # if stream, write chunks into PARTIAL_FOLDER instead of memory and
+    # resume from there if fail, return the file object, caller should close it
+    # refresh: async func to update token in headers in place, called once if
+    # got 401
     ok = False
     bin_data = b''
-    retry_n = 10
     if size > MAX_SIZE:
         log.warning(f'{download_url} too big {size} bp')
         return ok, bin_data
     log.info(f'Downloading {download_url.removesuffix("/download")} {size} bp')
-    while retry_n > 0:
-        retry_n -= 1
+    lock = None
+    if stream:
+        func = download_part
+        lock = download_locks.get(download_url)
+        await lock.acquire()
+    else:
+        func = download_once
+    try:
         try:
-            async with session.get(download_url, proxy=proxy, headers=headers
-                                   ) as resp:
-                if not resp.ok:
-                    log.warning(f'Download {download_url} fail {resp.status}')
-                    log.warning(f'Does headers invalid? {repr(headers)}')
-                    await asyncio.sleep(1.0)
-                    continue
-                bin_data = await resp.read()
-            if 'content-length' in resp.headers:
-                target_size = int(resp.headers['content-length'])
-            else:
-                # some response header is {'Transfer-Encoding': 'chunked'}
-                # without content length info
-                target_size = len(bin_data)
-            actual_size = len(bin_data)
-            if target_size != len(bin_data):
-                log.warning(
-                    f'Size mismatch {target_size} != {actual_size}')
-                await asyncio.sleep(1)
-            else:
-                ok = True
-                break
-        except KeyboardInterrupt:
-            raise
-        except BaseException as e:
-            log.warning(f'Download {download_url} fail {e}')
-            await asyncio.sleep(1)
+            bin_data = await retry_call(func, session, download_url, headers,
+                                        policy=policy)
+        except UnauthorizedError:
+            if refresh is None:
+                raise
+            log.warning(f'{download_url} unauthorized, refresh token')
+            await refresh()
+            bin_data = await retry_call(func, session, download_url, headers,
+                                        policy=policy)
+        ok = True
+        if lock is not None:
+            # released when caller close the file
+            bin_data.lock = lock
+            lock = None
+    except KeyboardInterrupt:
+        raise
+    except PermanentError as e:
+        log.warning(f'Download {download_url} fail {e}')
+        log.warning(f'Does headers invalid? {repr(headers)}')
+    except Exception as e:
+        log.warning(f'Download {download_url} fail {e!r}')
+    finally:
+        if lock is not None:
+            lock.release()
     if ok:
         log.info(f'Got {download_url}')
     else:
-        log.error(f'Download {download_url} fail with many tries')
+        log.error(f'Download {download_url} fail')
     return ok, bin_data
 
 
+async def download_once(session: aiohttp.ClientSession, download_url: str,
+                        headers: dict) -> bytes:
+    # one try of download, raise RetryableError or PermanentError if fail
+    await limiter.wait(download_url)
+    async with session.get(download_url, proxy=proxy, headers=headers
+                           ) as resp:
+        check_status(resp.status, resp.headers, download_url)
+        bin_data = await resp.read()
+    actual_size = len(bin_data)
+    if 'content-length' in resp.headers:
+        target_size = int(resp.headers['content-length'])
+    else:
+        # some response header is {'Transfer-Encoding': 'chunked'}
+        # without content length info
+        target_size = actual_size
+    if target_size != actual_size:
+        raise RetryableError(f'Size mismatch {target_size} != {actual_size}')
+    return bin_data
+
+
+def get_partial_file(download_url: str) -> Path:
+    # same url, same partial file, so it could be resumed in next run
+    name = sha256(download_url.encode()).hexdigest()[:32]
+    return PARTIAL_FOLDER / f'{name}.part'
+
+
+def parse_content_range(value: str) -> (int, int):
+    # 'bytes 100-199/1000' -> (100, 1000), total is -1 if unknown
+    unit, _, range_ = value.partition(' ')
+    span, _, total = range_.partition('/')
+    start = int(span.split('-')[0])
+    if total == '*':
+        return start, -1
+    return start, int(total)
+
+
+async def download_part(session: aiohttp.ClientSession, download_url: str,
+                        headers: dict) -> DownloadedFile:
+    # one try of download, continue from existed partial file
+    # ETag/Last-Modified of first response is kept in .meta, sent as If-Range
+    # so that changed file is downloaded again from start
+    # storageSize of dryad is size before zip, so only content-length and
+    # content-range are used for check
+    PARTIAL_FOLDER.mkdir(exist_ok=True)
+    part = get_partial_file(download_url)
+    meta = part.with_suffix('.meta')
+    offset = part.stat().st_size if part.exists() else 0
+    headers = dict(headers)
+    if offset > 0 and meta.exists():
+        validator = meta.read_text().strip()
+        headers['Range'] = f'bytes={offset}-'
+        if validator:
+            headers['If-Range'] = validator
+        log.info(f'Resume {download_url} from {offset} bp')
+    else:
+        offset = 0
+    await limiter.wait(download_url)
+    async with session.get(download_url, proxy=proxy, headers=headers
+                           ) as resp:
+        if resp.status == 416:
+            # local file is not a prefix of remote file any more
+            part.unlink(missing_ok=True)
+            raise RetryableError(f'{download_url} range not satisfiable')
+        try:
+            check_status(resp.status, resp.headers, download_url)
+        except PermanentError:
+            part.unlink(missing_ok=True)
+            meta.unlink(missing_ok=True)
+            raise
+        content_length = int(resp.headers.get('content-length', -1))
+        if resp.status == 206:
+            start, target_size = parse_content_range(
+                resp.headers.get('content-range', ''))
+            if start != offset:
+                part.unlink(missing_ok=True)
+                raise RetryableError(f'Bad range {start} != {offset}')
+            if target_size == -1 and content_length != -1:
+                target_size = offset + content_length
+            mode = 'ab'
+        else:
+            # server ignore Range or file changed, start over
+            offset = 0
+            target_size = content_length
+            mode = 'wb'
+            validator = resp.headers.get('ETag', resp.headers.get(
+                'Last-Modified', ''))
+            meta.write_text(validator)
+        try:
+            with open(part, mode) as out:
+                actual_size = offset + await read_chunks(resp, out, offset)
+        except TooBigError:
+            part.unlink(missing_ok=True)
+            meta.unlink(missing_ok=True)
+            raise
+    if target_size == -1:
+        # some response header is {'Transfer-Encoding': 'chunked'}
+        # without content length info
+        target_size = actual_size
+    if target_size != actual_size:
+        raise RetryableError(f'Size mismatch {target_size} != {actual_size}')
+    return DownloadedFile(part)
+
+
+async def read_chunks(resp: aiohttp.ClientResponse, out: BinaryIO,
+                      offset=0) -> int:
+    # copy response body into out by chunk, stop if exceed MAX_SIZE
+    # since storageSize of datasets is not always accurate
+    actual_size = 0
+    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+        actual_size += len(chunk)
+        if offset + actual_size > MAX_SIZE:
+            raise TooBigError(f'{actual_size} bp')
+        out.write(chunk)
+    return actual_size
+
+
+def write_stream(data: bytes | BinaryIO | Path, out_file: Path) -> None:
+    # write downloaded data (bytes, file object or file) to out_file
+    if isinstance(data, bytes):
+        out_file.write_bytes(data)
+        return
+    if isinstance(data, Path):
+        with open(data, 'rb') as src, open(out_file, 'wb') as out:
+            copyfileobj(src, out, CHUNK_SIZE)
+        return
+    data.seek(0)
+    with open(out_file, 'wb') as out:
+        copyfileobj(data, out, CHUNK_SIZE)
+    data.seek(0)
+
+
 def is_valid_tree(tmpfile: Path) -> bool:
     # test if file is newick or nexus tree
-    # if not, DELETE the file
-    content = tmpfile.read_text(errors='ignore')
-    try:
-        _ = dendropy.Tree.get(data=content, schema='newick')
-        return True
-    except Exception:
-        pass
-    try:
-        _ = dendropy.Tree.get(data=content, schema='nexus')
+    return check_tree_file(tmpfile) is not None
+
+
+def sniff_tree(content: str) -> str:
+    # cheap check before dendropy, return 'nexus', 'newick' or ''
+    text = content.lstrip('\ufeff \t\r\n')
+    if text[:6].upper() == '#NEXUS':
+        if NEXUS_TREES_PATTERN.search(text) is None:
+            return ''
+        return 'nexus'
+    text = text.rstrip()
+    # newick may start with comment like [&R]
+    if not text or text[0] not in '([' or text[-1] != ';':
+        return ''
+    if text.count('(') != text.count(')') or '(' not in text:
+        return ''
+    return 'newick'
+
+
+def is_valid_tree_content(content: str) -> bool:
+    # test if text is newick or nexus tree
+    return check_tree_content(content) is not None
+
+
+def check_tree_content(content: str) -> TreeInfo | None:
+    # dendropy only run on the first tree of text passed sniff_tree
+    if not sniff_tree(content):
+        return None
+    return scan_trees(StringIO(content))
+
+
+def check_tree_file(tree_file: Path) -> TreeInfo | None:
+    # read file line by line, never load whole file
+    with open(tree_file, 'r', encoding='utf-8', errors='ignore') as f:
+        info = scan_trees(f)
+    if info is not None:
+        info.tree_file = str(tree_file)
+    return info
+
+
+def get_tree_kind(tree_count: int) -> str:
+    if tree_count == 1:
+        return 'single'
+    elif tree_count >= POSTERIOR_MIN_TREES:
+        return 'posterior'
+    else:
+        return 'multiple'
+
+
+def scan_trees(lines: Iterable[str]) -> TreeInfo | None:
+    # validate the first tree with dendropy, only count others
+    # return None if not tree
+    lines = iter(lines)
+    for line in lines:
+        first = line.lstrip('\ufeff \t\r\n')
+        if not first:
+            continue
+        if first[:6].upper() == '#NEXUS':
+            return scan_nexus(chain([line], lines))
+        elif first[0] in '([':
+            return scan_newick(chain([line], lines))
+        else:
+            return None
+    return None
+
+
+def scan_nexus(lines: Iterable[str]) -> TreeInfo | None:
+    # read by statement, keep TAXA and TREES block (with TRANSLATE) till the
+    # first tree, skip other blocks like DATA, then count tree statements
+    # compact file with many statements in one line is ok
+    lines = iter(lines)
+    first = next(lines, '').lstrip('\ufeff \t\r\n')[6:]
+    head = ['#NEXUS\n']
+    block = ''
+    count = 0
+    for statement in iter_statements(chain([first], lines)):
+        command, argument = get_command(statement)
+        if command == 'begin':
+            block = argument
+        elif block == 'trees' and command in ('tree', 'utree'):
+            count += 1
+            if count > 1:
+                continue
+            content = ''.join(head) + statement + ';\nend;\n'
+            try:
+                tree = dendropy.Tree.get(data=content, schema='nexus')
+            except Exception:
+                return None
+            continue
+        if count == 0 and block in ('taxa', 'trees'):
+            head.append(statement + ';\n')
+        if command in ('end', 'endblock'):
+            block = ''
+    if count == 0:
+        return None
+    info = TreeInfo(schema='nexus', tree_count=count,
+                    kind=get_tree_kind(count))
+    info.add_tree(tree)
+    return info
+
+
+def scan_newick(lines: Iterable[str]) -> TreeInfo | None:
+    # each tree ends with ';'
+    count = 0
+    for statement in iter_statements(lines):
+        if not statement or statement.isspace():
+            continue
+        count += 1
+        if count > 1:
+            continue
+        try:
+            tree = dendropy.Tree.get(data=statement + ';', schema='newick')
+        except Exception:
+            return None
+    if count == 0:
+        return None
+    info = TreeInfo(schema='newick', tree_count=count,
+                    kind=get_tree_kind(count))
+    info.add_tree(tree)
+    return info
+
+
+def get_command(statement: str) -> (str, str):
+    # first two words of nexus statement in lower case, like 'begin', 'trees'
+    # tree statement may be very long, do not split it
+    match = COMMAND_PATTERN.match(statement)
+    if match is None:
+        return '', ''
+    return match.group(1).lower(), match.group(2).lower()
+
+
+def iter_statements(lines: Iterable[str]) -> Iterable[str]:
+    # yield each statement ending with ';', without comments and ';'
+    # only read lines till the statement is complete
+    buffer = ''
+    for line in lines:
+        buffer += line
+        if ';' not in line:
+            continue
+        if '[' in buffer:
+            buffer = COMMENT_PATTERN.sub('', buffer)
+            # ';' in unclosed comment is not the end, wait for ']'
+            if ';' not in buffer or '[' in buffer:
+                continue
+        if "'" not in buffer:
+            # no quoted label, much faster
+            *statements, buffer = buffer.split(';')
+            yield from statements
+            continue
+        end = 0
+        for match in STATEMENT_PATTERN.finditer(buffer):
+            yield match.group()[:-1]
+            end = match.end()
+        buffer = buffer[end:]
+
+
+def get_label(token: str) -> str:
+    # same as dendropy, underscore in unquoted label is blank
+    if token[0] == "'":
+        return token[1:-1].replace("''", "'")
+    return token.replace('_', ' ')
+
+
+def get_newick_labels(newick: str) -> list[str] | None:
+    # tip label follows '(' or ',' or is the whole tree,
+    # internal label follows ')', branch length follows ':'
+    # return None if parentheses not match
+    if newick.count('(') != newick.count(')'):
+        return None
+    labels = dict.fromkeys(get_label(i) for i in TIP_PATTERN.findall(newick))
+    return list(labels)
+
+
+def scan_tip_labels(lines: Iterable[str]) -> list[str] | None:
+    # get labels like TreeInfo.add_tree without building tree
+    # nexus: TAXLABELS, or TRANSLATE, or the first tree statement
+    # newick: the first tree
+    # return None if not recognized, caller may use dendropy instead
+    lines = iter(lines)
+    for line in lines:
+        first = line.lstrip('\ufeff \t\r\n')
+        if first:
+            break
+    else:
+        return None
+    if first[:6].upper() != '#NEXUS':
+        for statement in iter_statements(chain([first], lines)):
+            return get_newick_labels(statement)
+        return None
+    lines = chain([first[6:]], lines)
+    block = ''
+    for statement in iter_statements(lines):
+        command, argument = get_command(statement)
+        if command == 'begin':
+            block = argument
+        elif command in ('end', 'endblock'):
+            block = ''
+        elif block == 'taxa' and command == 'taxlabels':
+            tokens = TOKEN_PATTERN.findall(statement)[1:]
+            return [get_label(i) for i in tokens]
+        elif block == 'trees' and command == 'translate':
+            # key label, key label, ...
+            tokens = TOKEN_PATTERN.findall(statement)[1:]
+            labels = list()
+            previous = ','
+            for token in tokens:
+                if previous != ',' and token != ',':
+                    labels.append(get_label(token))
+                previous = token
+            return labels
+        elif block == 'trees' and command in ('tree', 'utree'):
+            name, equal, newick = statement.partition('=')
+            if not equal:
+                return None
+            return get_newick_labels(newick)
+    return None
+
+
+def get_tip_labels(tree_file: Path) -> list[str] | None:
+    with open(tree_file, 'r', encoding='utf-8', errors='ignore') as f:
+        return scan_tip_labels(f)
+
+
+def get_member_path(filename: str, out_folder: Path) -> Path:
+    # same as ZipFile.extract, remove drive, '..' and '.' from path
+    parts = [i for i in re.split(r'[/\\]', filename)
+             if i not in ('', '.', '..')]
+    if parts and re.match(r'^[A-Za-z]:$', parts[0]):
+        parts = parts[1:]
+    return out_folder.joinpath(*parts)
+
+
+def write_tree_file(data: bytes | Path, out_file: Path) -> list[TreeInfo]:
+    # write one downloaded file, return tree files in it
+    # zip is extracted into the folder of out_file
+    # run in process pool, so data is bytes or path of downloaded file
+    suffix = out_file.suffix.lower()
+    if suffix in ZIP_SUFFIX:
+        return filter_tree_from_zip(data, out_file.parent)
+    if suffix not in TARGET_SUFFIX:
+        return []
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    write_stream(data, out_file)
+    info = check_tree_file(out_file)
+    if info is not None:
+        return [info]
+    log.info(f'{out_file.name} is not valid tree')
+    out_file.unlink()
+    return []
+
+
+class UnzipBudget:
+    # limit total uncompressed size of all (nested) zip members, avoid zip bomb
+    def __init__(self, size=MAX_UNZIP_SIZE):
+        self.left = size
+
+    def take(self, size: int) -> bool:
+        if size > self.left:
+            return False
+        self.left -= size
         return True
-    except Exception:
-        pass
-    return False
 
 
-def extract_tree(z: ZipFile, out_folder: Path):
+def extract_tree(z: ZipFile, out_folder: Path, depth=0,
+                 budget: UnzipBudget = None):
     # since one paper one folder, it's hardly to overwrite existed file
-    for file in z.namelist():
+    # tree candidates are checked by streaming the member, only trees are
+    # written, by decompressing the member again
+    # nested zip is opened from memory or temp file, not out_folder
+    if budget is None:
+        budget = UnzipBudget()
+    for info in z.infolist():
+        file = info.filename
+        if info.is_dir():
+            continue
         suffix = Path(file).suffix.lower()
         if suffix not in TARGET_SUFFIX:
             log.warning(f'{file} is not tree')
             continue
-        # tmpfile = out_folder / file
-        try:
-            actual_filename = z.extract(file, path=out_folder)
-            tmpfile = Path(actual_filename)
-        except FileNotFoundError:
-            continue
+        if not budget.take(info.file_size):
+            log.error(f'Stop extracting {file}, uncompressed size over '
+                      f'{MAX_UNZIP_SIZE} bp')
+            return
         if (suffix in TXT_SUFFIX or suffix in NEXUS_SUFFIX or
                 suffix in TREE_SUFFIX):
-            if is_valid_tree(tmpfile):
-                yield tmpfile
-            else:
+            with z.open(info) as member:
+                tree_info = scan_trees(TextIOWrapper(
+                    member, encoding='utf-8', errors='ignore'))
+            if tree_info is None:
                 log.warning(f'{file} is not tree')
-                tmpfile.unlink()
+                continue
+            tmpfile = get_member_path(file, out_folder)
+            try:
+                tmpfile.parent.mkdir(parents=True, exist_ok=True)
+                with z.open(info) as member, open(tmpfile, 'wb') as out:
+                    copyfileobj(member, out, CHUNK_SIZE)
+            except OSError as e:
+                log.error(f'Write {tmpfile} fail {e}')
+                continue
+            tree_info.tree_file = str(tmpfile)
+            yield tree_info
         elif suffix in ZIP_SUFFIX:
-            log.info(f'Extracting {file}')
-            target_filename = out_folder / file
-            # filename contain '..'
-            if not target_filename.exists():
+            if depth >= MAX_ZIP_DEPTH:
+                log.warning(f'Skip {file}, nested more than {MAX_ZIP_DEPTH}')
                 continue
-            with ZipFile(target_filename, 'r') as zz:
-                yield from extract_tree(zz, out_folder)
-            tmpfile.unlink()
+            log.info(f'Extracting {file}')
+            # ZipFile need seek, ZipExtFile is too slow for that
+            with SpooledTemporaryFile(max_size=MEMORY_CHECK_SIZE) as tmp:
+                with z.open(info) as member:
+                    copyfileobj(member, tmp, CHUNK_SIZE)
+                tmp.seek(0)
+                try:
+                    with ZipFile(tmp, 'r') as zz:
+                        yield from extract_tree(zz, out_folder, depth + 1,
+                                                budget)
+                except BadZipfile:
+                    log.warning(f'Bad zip file {file}')
         else:
             pass
 
 
-def filter_tree_from_zip(file_bin: bytes, out_folder: Path) -> list:
+def filter_tree_from_zip(file_bin: bytes | BinaryIO | Path,
+                         out_folder: Path) -> list[TreeInfo]:
     # filter tree files from zip
     # extract trees into OUT_FOLDER/
+    # accept bytes, file-like object or path of zip file
     tree_files = list()
+    if isinstance(file_bin, bytes):
+        file_bin = BytesIO(file_bin)
     try:
-        with ZipFile(BytesIO(file_bin), 'r') as z:
+        with ZipFile(file_bin, 'r') as z:
             for tree_file in extract_tree(z, out_folder):
                 tree_files.append(tree_file)
     except BadZipfile:
@@ -218,5 +1026,90 @@ def filter_tree_from_zip(file_bin: bytes, out_folder: Path) -> list:
     return tree_files
 
 
+def hash_files(files: list[Path]) -> list[str]:
+    digests = list()
+    for file in files:
+        h = sha256()
+        with open(file, 'rb') as f:
+            while chunk := f.read(CHUNK_SIZE):
+                h.update(chunk)
+        digests.append(h.hexdigest())
+    return digests
+
+
+class TreeStore:
+    # content addressed index of tree files, same content only keep one file
+    # index is appended to jsonl file, only used in main process
+    def __init__(self, index_file: Path):
+        self.index_file = index_file
+        self.index = dict()
+        if index_file.exists():
+            with open(index_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.index[record['hash']] = record['path']
+
+    def add(self, tree_file: Path, digest: str) -> Path:
+        # return path of first copy, remove duplicate file
+        old = self.index.get(digest, None)
+        if old is not None and old != str(tree_file) and Path(old).exists():
+            log.info(f'{tree_file} is same as {old}')
+            tree_file.unlink(missing_ok=True)
+            try:
+                # remove empty folder
+                tree_file.parent.rmdir()
+            except OSError:
+                pass
+            return Path(old)
+        self.index[digest] = str(tree_file)
+        with open(self.index_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'hash': digest, 'path': str(tree_file)}) + '\n')
+        return tree_file
+
+
+tree_store = TreeStore(TREE_INDEX)
+
+
+async def store_trees(trees: list[TreeInfo]) -> list[TreeInfo]:
+    # replace duplicate tree files with reference to first copy
+    if not trees:
+        return trees
+    digests = await run_in_pool(hash_files,
+                                [Path(i.tree_file) for i in trees])
+    stored = dict()
+    for tree_info, digest in zip(trees, digests):
+        path = tree_store.add(Path(tree_info.tree_file), digest)
+        tree_info.tree_file = str(path)
+        stored.setdefault(tree_info.tree_file, tree_info)
+    return list(stored.values())
+
+
+_process_pool = None
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=PROCESS_WORKERS)
+    return _process_pool
+
+
+def to_pool_arg(data: bytes | BinaryIO | Path) -> bytes | Path:
+    # file object cannot be sent to other process, use its path instead
+    if isinstance(data, DownloadedFile):
+        return data.path
+    return data
+
+
+async def run_in_pool(func, *args):
+    # run cpu bound func in process pool, keep event loop free for network
+    # args and return value should be picklable
+    if PROCESS_WORKERS <= 0:
+        return func(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_process_pool(), func, *args)
+
+
 def pprint(raw: dict):
     print(json.dumps(raw, indent=True))
\ No newline at end of file